@@ -0,0 +1,250 @@
+import gzip
+import hashlib
+import json
+
+from flask import Blueprint, Response, request, url_for
+from flask_login import current_user
+import sqlalchemy as sa
+
+from app.books import reviews_sort_keys
+from app.constants import REVIEW_STATUSES
+from app.models import db, Book, Review, Collection, book_collection
+from app.pagination import keyset_paginate
+from app.tools import BooksFilter, books_filter_params
+from app.viewmodels import genre_map
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+PER_PAGE = 20
+MAX_PER_PAGE = 100
+# Ответы короче этого размера не сжимаются: заголовки gzip съедят выигрыш
+GZIP_MIN_SIZE = 500
+
+# Поле ответа -> колонки, которые нужно для него выбрать
+BOOK_FIELDS = {
+    'id': (Book.id,),
+    'name': (Book.name,),
+    'author': (Book.author,),
+    'publishing_house': (Book.publishing_house,),
+    'volume': (Book.volume,),
+    'created_at': (Book.created_at,),
+    'short_desc': (Book.short_desc,),
+    'rating': (Book.rating_num, Book.rating_sum),
+    'review_count': (Book.approved_review_count,),
+    'image_url': (Book.background_image_id,),
+    'genres': (),
+}
+BOOK_LIST_FIELDS = ('id', 'name', 'author', 'created_at', 'rating', 'review_count', 'image_url', 'genres')
+
+REVIEW_FIELDS = {
+    'id': (Review.id,),
+    'user_id': (Review.user_id,),
+    'rating': (Review.rating,),
+    'text': (Review.text,),
+    'created_at': (Review.created_at,),
+}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@bp.errorhandler(ApiError)
+def api_error(e):
+    return json_response({'error': e.message}, status=e.status)
+
+
+def json_response(data, status=200):
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_default)
+    return Response(body, status=status, mimetype='application/json')
+
+
+def _default(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(sep=' ')
+    raise TypeError(f'Unsupported value {value!r}')
+
+
+# Поля, запрошенные через fields=; без параметра - поля по умолчанию
+def requested_fields(available, default):
+    value = request.args.get('fields')
+    fields = [field.strip() for field in value.split(',') if field.strip()] if value else list(default)
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise ApiError(400, f'Неизвестные поля: {", ".join(unknown)}. Доступны: {", ".join(available)}')
+    return fields
+
+
+# Колонки для запрошенных полей; required выбираются всегда (id и version для ETag)
+def select_columns(available, fields, *required):
+    columns = list(required)
+    for field in fields:
+        for column in available[field]:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+# Те же правила доступа, что у HTML-страниц: карточка книги и рецензии только для вошедших
+def require_login():
+    if not current_user.is_authenticated:
+        raise ApiError(401, 'Требуется авторизация')
+
+
+def per_page():
+    return min(max(request.args.get('limit', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+
+
+# ETag слабый: одно и то же содержимое отдается и сжатым, и несжатым
+def conditional(payload, version_key):
+    etag = hashlib.md5(repr(version_key).encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = json_response(payload() if callable(payload) else payload)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+# Жанры всех книг страницы одним запросом
+def genres_for(book_ids):
+    return {book_id: [{'id': genre.id, 'name': genre.name} for genre in genres]
+            for book_id, genres in genre_map(book_ids).items()}
+
+
+def book_json(row, fields, genres):
+    data = {}
+    for field in fields:
+        if field == 'rating':
+            data[field] = round(row['rating_sum'] / row['rating_num'], 2) if row['rating_num'] else 0
+        elif field == 'review_count':
+            data[field] = row['approved_review_count']
+        elif field == 'image_url':
+            image_id = row['background_image_id']
+            data[field] = url_for('image', image_id=image_id) if image_id else None
+        elif field == 'genres':
+            data[field] = genres[row['id']]
+        else:
+            data[field] = row[field]
+    return data
+
+
+def page_json(items, pagination):
+    return {
+        'items': items,
+        'next_cursor': pagination.next_cursor,
+        'prev_cursor': pagination.prev_cursor,
+    }
+
+
+@bp.route('/books')
+def books():
+    fields = requested_fields(BOOK_FIELDS, BOOK_LIST_FIELDS)
+    # Каталог открыт всем, как books.index, а описание книги есть только на ее странице
+    if 'short_desc' in fields:
+        require_login()
+    columns = select_columns(BOOK_FIELDS, fields, Book.id, Book.version)
+    books_filter = BooksFilter(**books_filter_params(request.args))
+    pagination = keyset_paginate(books_filter.query.with_entities(*columns), books_filter.sort_keys(), per_page())
+    names = [column.key for column in columns]
+    rows = [dict(zip(names, item)) for item in pagination.items]
+
+    def payload():
+        genres = genres_for([row['id'] for row in rows]) if 'genres' in fields else None
+        return page_json([book_json(row, fields, genres) for row in rows], pagination)
+
+    return conditional(payload, (fields, [(row['id'], row['version']) for row in rows], pagination.next_cursor))
+
+
+@bp.route('/books/<int:book_id>')
+def book(book_id):
+    require_login()
+    fields = requested_fields(BOOK_FIELDS, BOOK_FIELDS)
+    columns = select_columns(BOOK_FIELDS, fields, Book.id, Book.version)
+    row = db.session.query(*columns).filter(Book.id == book_id).first()
+    if row is None:
+        raise ApiError(404, 'Книга не найдена')
+    row = dict(row._mapping)
+
+    def payload():
+        genres = genres_for([book_id]) if 'genres' in fields else None
+        return book_json(row, fields, genres)
+
+    return conditional(payload, (fields, book_id, row['version']))
+
+
+# Одобренные рецензии книги. Одобрение и удаление рецензии увеличивает версию книги,
+# поэтому ETag страницы строится по ней без чтения самих рецензий
+@bp.route('/books/<int:book_id>/reviews')
+def book_reviews(book_id):
+    require_login()
+    fields = requested_fields(REVIEW_FIELDS, REVIEW_FIELDS)
+    version = db.session.query(Book.version).filter(Book.id == book_id).scalar()
+    if version is None:
+        raise ApiError(404, 'Книга не найдена')
+    sort_reviews = request.args.get('sort_reviews')
+    key = (fields, book_id, version, sort_reviews, request.args.get('cursor'), per_page())
+
+    def payload():
+        columns = select_columns(REVIEW_FIELDS, fields, Review.id)
+        query = db.session.query(*columns) \
+            .filter(Review.book_id == book_id, Review.status_id == REVIEW_STATUSES['APPROVED']['id'])
+        pagination = keyset_paginate(query, reviews_sort_keys(sort_reviews), per_page())
+        names = [column.key for column in columns]
+        rows = [dict(zip(names, item if len(columns) > 1 else (item,))) for item in pagination.items]
+        items = [{field: row[field] for field in fields} for row in rows]
+        return page_json(items, pagination)
+
+    return conditional(payload, key)
+
+
+# Подборки текущего пользователя с количеством книг; у подборок нет версии, поэтому ETag - хэш содержимого
+@bp.route('/collections')
+def collections():
+    require_login()
+    book_count = sa.select(sa.func.count()) \
+        .where(book_collection.c['collection.id'] == Collection.id) \
+        .scalar_subquery()
+    query = db.session.query(Collection.id, Collection.name, Collection.desc, book_count.label('book_count')) \
+        .filter(Collection.user_id == current_user.id)
+    pagination = keyset_paginate(query, [(Collection.id, False)], per_page())
+    items = [dict(zip(('id', 'name', 'desc', 'book_count'), item)) for item in pagination.items]
+    payload = page_json(items, pagination)
+    return conditional(payload, payload)
+
+
+@bp.route('/collections/<int:collection_id>')
+def collection(collection_id):
+    require_login()
+    row = db.session.query(Collection.id, Collection.name, Collection.desc) \
+        .filter(Collection.id == collection_id, Collection.user_id == current_user.id) \
+        .first()
+    if row is None:
+        raise ApiError(404, 'Подборка не найдена')
+    book_ids = [book_id for book_id, in db.session.query(book_collection.c['book.id'])
+                .filter(book_collection.c['collection.id'] == collection_id)
+                .order_by(book_collection.c.position, book_collection.c['book.id'])]
+    payload = dict(row._mapping, book_ids=book_ids)
+    return conditional(payload, payload)
+
+
+# Vary ставится на любой успешный ответ, в том числе несжатый: иначе общий кэш
+# отдаст сохраненный несжатый вариант и тем, кто принимает gzip
+@bp.after_request
+def compress(response):
+    if response.status_code != 200:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or 'gzip' not in request.accept_encodings \
+            or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
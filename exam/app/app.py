@@ -1,10 +1,23 @@
-from flask import Flask, render_template, abort, send_from_directory
+from flask import Flask, render_template, abort, request, make_response
 from flask_migrate import Migrate
 
+from app.api import bp as api_bp
 from app.auth import bp as auth_bp, init_login_manager
 from app.books import bp as books_bp
 from app.collections_books import bp as collections_bp
-from app.models import db, Image
+from app.export import bp as export_bp
+from app.models import db
+from app.fragments import init_fragment_cache
+from app.tools import image_info
+from app.variants import pick_variant
+from app.storage import images_cli, init_storage, storage, shard_key
+from app.image_gc import sweep, gc
+from app.plans import check_plans
+from app.seed import seed
+from app.bench import bench
+from app.similar import similar_cli
+from app.sqlstats import init_sql_stats
+from app.routing import init_replicas
 
 # Создаем экземпляр приложения Flask
 app = Flask(__name__)
@@ -15,31 +28,85 @@ app.config.from_pyfile('config.py')
 
 # Инициализация базы данных и миграций
 db.init_app(app)
+init_replicas(app)
 migrate = Migrate(app, db)
 
 # Регистрация blueprint'ов
 app.register_blueprint(auth_bp)
 app.register_blueprint(books_bp)
 app.register_blueprint(collections_bp)
+app.register_blueprint(export_bp)
+app.register_blueprint(api_bp)
+
+# Команды обслуживания изображений: flask images ...
+images_cli.add_command(sweep)
+images_cli.add_command(gc)
+app.cli.add_command(images_cli)
+
+# Проверка планов выполнения горячих запросов: flask check-plans
+app.cli.add_command(check_plans)
+
+# Синтетические данные и замеры страниц: flask seed, flask bench
+app.cli.add_command(seed)
+app.cli.add_command(bench)
+
+# Расчет похожих книг: flask similar rebuild, flask similar refresh
+app.cli.add_command(similar_cli)
 
 # Инициализация менеджера сессий
 init_login_manager(app)
 
+# Хранилище файлов изображений
+init_storage(app)
+
+# Кэш отрендеренных фрагментов страниц
+init_fragment_cache(app)
+
+# Статистика SQL по запросам (включается SQL_STATS)
+init_sql_stats(app)
+
+# Разделение разрядов пробелом: 1240 -> "1 240"
+@app.template_filter('thousands')
+def thousands(value):
+    return f'{value:,}'.replace(',', ' ')
+
 # Обработчик для главной страницы
 @app.route('/')
 def index():
     return render_template('index.html')
 
-# Обработчик для отображения изображений
+# Обработчик для отображения изображений.
+# Содержимое изображения не меняется, поэтому ETag - это его md5, а кэширование бессрочное.
+# С параметром w отдается готовая уменьшенная копия (webp, если браузер его принимает),
+# а пока копии не построены - оригинал
 @app.route('/images/<image_id>')
 def image(image_id):
-    img = Image.query.get(image_id)
-    if img is None:
+    info = image_info(image_id)
+    if info is None:
         abort(404)
-    return send_from_directory(
-        app.config['UPLOAD_FOLDER'],
-        img.storage_filename
-    )
+    key, mime_type, etag = info.storage_key, info.mime_type, info.md5_hash
+    max_age = app.config['IMAGE_MAX_AGE']
+    width = request.args.get('w', type=int)
+    if width:
+        accept_webp = any(value == 'image/webp' for value, quality in request.accept_mimetypes if quality)
+        variant = pick_variant(image_id, width, accept_webp)
+        if variant is not None:
+            key, mime_type = shard_key(info.md5_hash, variant.file_name), variant.mime_type
+            etag = f'{info.md5_hash}-{variant.width}-{variant.format}'
+        else:
+            # Оригинал вместо еще не построенной копии кэшируется ненадолго
+            max_age = app.config['IMAGE_PENDING_MAX_AGE']
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+        response.set_etag(etag)
+    else:
+        response = storage().send(key, mime_type, etag, max_age)
+    if width:
+        response.vary.add('Accept')
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = max_age == app.config['IMAGE_MAX_AGE']
+    return response
 
 # Точка входа
 if __name__ == '__main__':
@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, render_template, redirect, url_for, flash, request, g
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from functools import wraps
 from app.models import User
@@ -15,9 +15,13 @@ def init_login_manager(app):
     login_manager.user_loader(load_user)
     login_manager.init_app(app)
 
-# Загрузка пользователя по ID
+# Загрузка пользователя по ID, не больше одного запроса на пользователя за HTTP-запрос
 def load_user(user_id):
-    return User.query.get(user_id)
+    users = g.setdefault('loaded_users', {})
+    user_id = int(user_id)
+    if user_id not in users:
+        users[user_id] = User.query.get(user_id)
+    return users[user_id]
 
 # Обработчик для входа пользователя
 @bp.route('/login', methods=['GET', 'POST'])
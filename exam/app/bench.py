@@ -0,0 +1,260 @@
+import http.cookiejar
+import json
+import re
+import statistics
+import subprocess
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app, url_for
+from flask.cli import with_appcontext
+import sqlalchemy as sa
+
+from app.constants import REVIEW_STATUSES
+from app.models import db, Book, Review, Collection, User
+from app.seed import BENCH_USERS
+
+BLUEPRINTS = ('books', 'collections', 'auth')
+SERVER_TIMING_SQL = re.compile(r'desc="(\d+) SQL"')
+
+# Сценарий замера: role - чьей сессией открывается страница (None - без входа),
+# before - действие перед каждым запросом, которое в замер не входит
+Scenario = namedtuple('Scenario', 'name role method url data before', defaults=(None, None))
+
+Sample = namedtuple('Sample', 'status duration sql')
+
+
+def scenarios(ids, login_data):
+    return [
+        Scenario('books.index', None, 'GET', url_for('books.index')),
+        Scenario('books.index?name', None, 'GET', url_for('books.index', name='город')),
+        Scenario('books.index?genre_ids', None, 'GET', url_for('books.index', genre_ids=2)),
+        Scenario('books.new', 'admin', 'GET', url_for('books.new')),
+        Scenario('books.edit', 'admin', 'GET', url_for('books.edit', book_id=ids['popular_book'])),
+        Scenario('books.show', 'user', 'GET', url_for('books.show', book_id=ids['popular_book'])),
+        Scenario('books.show (редкая книга)', 'user', 'GET', url_for('books.show', book_id=ids['rare_book'])),
+        Scenario('books.give_review', 'user', 'GET', url_for('books.give_review', book_id=ids['rare_book'])),
+        Scenario('books.reviews', 'user', 'GET', url_for('books.reviews', book_id=ids['popular_book'])),
+        Scenario('books.my_reviews', 'user', 'GET', url_for('books.my_reviews')),
+        Scenario('books.reviews_to_moderate', 'moder', 'GET', url_for('books.reviews_to_moderate')),
+        Scenario('books.review', 'moder', 'GET', url_for('books.review', review_id=ids['pending_review'])),
+        Scenario('collections.index', 'user', 'GET', url_for('collections.index')),
+        Scenario('collections.show_collection', 'user', 'GET',
+                 url_for('collections.show_collection', collection_id=ids['collection'])),
+        Scenario('auth.login', None, 'GET', url_for('auth.login')),
+        Scenario('auth.login (вход)', None, 'POST', url_for('auth.login'), login_data['user'], 'new_session'),
+        Scenario('auth.logout', None, 'GET', url_for('auth.logout'), None, 'login'),
+    ]
+
+
+# Страницы, на которых измеряется бенчмарк: самая популярная и одна из самых редких книг,
+# подборка пользователя бенчмарка и рецензия на модерации
+def sample_ids():
+    bench_user_id = db.session.query(User.id).filter(User.login == BENCH_USERS['user'][0]).scalar()
+    if bench_user_id is None:
+        raise click.ClickException('Нет пользователей бенчмарка, сначала выполните flask seed')
+    ids = {
+        'popular_book': db.session.query(Book.id).order_by(Book.approved_review_count.desc(), Book.id).limit(1).scalar(),
+        'rare_book': db.session.query(Book.id).order_by(Book.approved_review_count, Book.id.desc()).limit(1).scalar(),
+        'collection': db.session.query(Collection.id).filter(Collection.user_id == bench_user_id)
+            .order_by(Collection.id).limit(1).scalar(),
+        'pending_review': db.session.query(Review.id)
+            .filter(Review.status_id == REVIEW_STATUSES['UNDER_MODERATION']['id'])
+            .order_by(Review.id).limit(1).scalar(),
+    }
+    missing = [name for name, value in ids.items() if value is None]
+    if missing:
+        raise click.ClickException(f'В базе не хватает данных для замера: {", ".join(missing)}')
+    return ids
+
+
+# Запросы через тестовый клиент WSGI в том же процессе; число SQL считается по событиям движка
+class TestClientTransport:
+    def __init__(self, app):
+        self.app = app
+        self.sql = 0
+
+    def __enter__(self):
+        sa.event.listen(db.engine, 'after_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        sa.event.remove(db.engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.sql += 1
+
+    def session(self):
+        return self.app.test_client()
+
+    def request(self, session, method, url, data=None):
+        self.sql = 0
+        started = time.perf_counter()
+        response = session.open(url, method=method, data=data)
+        duration = time.perf_counter() - started
+        response.close()
+        return Sample(response.status_code, duration, self.sql)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# Запросы к запущенному серверу; число SQL берется из Server-Timing, если на сервере включен SQL_STATS
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def session(self):
+        return urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, session, method, url, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        started = time.perf_counter()
+        try:
+            with session.open(urllib.request.Request(self.base_url + url, data=body, method=method)) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as e:
+            e.read()
+            status, headers = e.code, e.headers
+        duration = time.perf_counter() - started
+        match = SERVER_TIMING_SQL.search(headers.get('Server-Timing', ''))
+        return Sample(status, duration, int(match.group(1)) if match else None)
+
+
+def login(transport, role, login_url, login_data):
+    session = transport.session()
+    transport.request(session, 'POST', login_url, login_data[role])
+    return session
+
+
+def run_scenario(transport, scenario, sessions, requests, warmup, login_url, login_data):
+    samples = []
+    session = sessions.get(scenario.role)
+    for i in range(warmup + requests):
+        if scenario.before == 'new_session':
+            session = transport.session()
+        elif scenario.before == 'login':
+            session = login(transport, 'user', login_url, login_data)
+        sample = transport.request(session, scenario.method, scenario.url, scenario.data)
+        if i >= warmup:
+            samples.append(sample)
+    return samples
+
+
+def summarize(scenario, samples):
+    durations = sorted(sample.duration * 1000 for sample in samples)
+    cuts = statistics.quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+    sql = [sample.sql for sample in samples if sample.sql is not None]
+    return {
+        'url': scenario.url,
+        'method': scenario.method,
+        'role': scenario.role,
+        'requests': len(samples),
+        'statuses': dict(Counter(str(sample.status) for sample in samples)),
+        'rps': round(len(samples) / (sum(durations) / 1000), 1) if sum(durations) else None,
+        'mean_ms': round(statistics.fmean(durations), 2),
+        'p50_ms': round(cuts[49], 2),
+        'p95_ms': round(cuts[94], 2),
+        'p99_ms': round(cuts[98], 2),
+        'sql_mean': round(statistics.fmean(sql), 1) if sql else None,
+        'sql_max': max(sql) if sql else None,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_compare(results, baseline):
+    click.echo(f'\nСравнение с {baseline.get("commit") or "предыдущим запуском"} по p95:')
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if previous and previous['p95_ms']:
+            change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100
+            click.echo(f'{name:<40} {previous["p95_ms"]:>9.2f} -> {current["p95_ms"]:>9.2f} мс ({change:+.0f}%)')
+
+
+@click.command('bench')
+@click.option('--requests', default=100, show_default=True, help='Замеряемых запросов на страницу.')
+@click.option('--warmup', default=10, show_default=True, help='Запросов на прогрев, в замер не входят.')
+@click.option('--url', 'base_url', help='Адрес запущенного сервера; по умолчанию тестовый клиент WSGI.')
+@click.option('--password', default='bench', show_default=True, help='Пароль пользователей bench_* из flask seed.')
+@click.option('--only', help='Регулярное выражение для имен сценариев.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Сохранить результаты в JSON.')
+@click.option('--compare', type=click.File(), help='JSON предыдущего запуска для сравнения.')
+@with_appcontext
+def bench(requests, warmup, base_url, password, only, output, compare):
+    """Замерить задержки и число SQL-запросов страниц books, collections и auth.
+
+    Нужна база, заполненная flask seed: запросы идут от имени пользователей bench_*.
+    Изменяющие данные обработчики не замеряются и перечисляются в конце отчета.
+    """
+    app = current_app._get_current_object()
+    with app.test_request_context():
+        login_url = url_for('auth.login')
+        login_data = {role: {'login': login, 'password': password} for role, (login, _) in BENCH_USERS.items()}
+        all_scenarios = scenarios(sample_ids(), login_data)
+    if only:
+        all_scenarios = [scenario for scenario in all_scenarios if re.search(only, scenario.name)]
+
+    transport = HttpTransport(base_url) if base_url else TestClientTransport(app)
+    results = {
+        'commit': _commit(),
+        'started_at': datetime.now().isoformat(sep=' ', timespec='seconds'),
+        'database': db.engine.dialect.name,
+        'transport': 'http' if base_url else 'wsgi',
+        'rows': {model.__tablename__: db.session.query(sa.func.count(model.id)).scalar()
+                 for model in (Book, Review, User, Collection)},
+        'endpoints': {},
+    }
+
+    def measure():
+        sessions = {None: transport.session()}
+        for role in BENCH_USERS:
+            sessions[role] = login(transport, role, login_url, login_data)
+        for scenario in all_scenarios:
+            samples = run_scenario(transport, scenario, sessions, requests, warmup, login_url, login_data)
+            summary = summarize(scenario, samples)
+            results['endpoints'][scenario.name] = summary
+            sql = '-' if summary['sql_mean'] is None else f'{summary["sql_mean"]:.1f}'
+            click.echo(f'{scenario.name:<40} {summary["rps"] or 0:>8.1f} {summary["p50_ms"]:>8.2f} '
+                       f'{summary["p95_ms"]:>8.2f} {summary["p99_ms"]:>8.2f} {sql:>6}  {summary["statuses"]}')
+
+    click.echo(f'{"сценарий":<40} {"зап/с":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"SQL":>6}  статусы')
+    # Запросы идут из отдельного потока: в нем нет контекста приложения этой команды,
+    # и каждый запрос, как на сервере, получает свою сессию БД и свой g
+    with transport, ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(measure).result()
+
+    measured = {scenario.name.split(' ')[0].split('?')[0] for scenario in all_scenarios}
+    skipped = sorted({rule.endpoint for rule in app.url_map.iter_rules()
+                      if rule.endpoint.split('.')[0] in BLUEPRINTS and rule.endpoint not in measured})
+    results['skipped'] = skipped
+    if skipped:
+        click.echo(f'Не замерялись: {", ".join(skipped)}')
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if compare:
+        _print_compare(results, json.load(compare))
@@ -1,20 +1,30 @@
-import os
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import Blueprint, render_template, request, flash, redirect, url_for
 from flask_login import current_user, login_required
 import sqlalchemy as sa
 import markdown
 import bleach
+import click
 
 from app import app
 from app.auth import permission_check
 from app.constants import REVIEW_STATUSES
-from app.models import db, Book, Genre, User, Review, Image, Collection
-from app.tools import BooksFilter, ImageSaver
-from sqlalchemy import distinct
+from app.models import db, Book, Genre, User, Review, Image, Collection, SimilarBook
+from app.tools import BooksFilter, ImageSaver, ImageTooLarge, books_filter_params
+from app.search import index_book, remove_book, rebuild_index
+from app.importer import import_books
+from app.pagination import keyset_paginate
+from app.facets import BookFacets
+from app import reference
+from app.fragments import book_cards, book_page
+from app.viewmodels import REVIEW_COLUMNS, review_views
+from app.variants import schedule_variants
 bp = Blueprint('books', __name__, url_prefix='/books')
 
 PER_PAGE = 9
+COLLECTIONS_LIMIT = 50
+SIMILAR_SHOWN = 6
 
 BOOK_PARAMS = [
     'author', 'name', 'publishing_house', 'volume', 'created_at'
@@ -34,42 +44,74 @@ def search_params():
     }
 
 
+def reviews_sort_keys(sort_reviews):
+    if sort_reviews == 'positive':
+        return [(Review.rating, True), (Review.id, True)]
+    if sort_reviews == 'negative':
+        return [(Review.rating, False), (Review.id, True)]
+    return [(Review.created_at, True), (Review.id, True)]
+
+
+# Запросы страниц вынесены из обработчиков, чтобы flask check-plans и тесты проверяли
+# планы именно тех запросов, которые выполняют страницы.
+# Для постраничных страниц возвращается пара (запрос, ключи сортировки) для keyset_paginate
+def catalogue_query(filter_params):
+    books_filter = BooksFilter(**filter_params)
+    return books_filter.query.with_entities(Book.id, Book.version), books_filter.sort_keys()
+
+
+def latest_reviews_query(book_id):
+    return Review.query \
+        .filter_by(book_id=book_id, status_id=REVIEW_STATUSES['APPROVED']['id']) \
+        .order_by(Review.created_at.desc()) \
+        .limit(5)
+
+
+def own_review_query(user_id, book_id):
+    return Review.query.filter_by(user_id=user_id).filter_by(book_id=book_id)
+
+
+def book_reviews_query(book_id, sort_reviews=None):
+    return Review.query.filter_by(book_id=book_id, status_id=REVIEW_STATUSES['APPROVED']['id']), \
+        reviews_sort_keys(sort_reviews)
+
+
+def my_reviews_query(user_id, sort_reviews=None):
+    return db.session.query(*REVIEW_COLUMNS).filter(Review.user_id == user_id), reviews_sort_keys(sort_reviews)
+
+
 @bp.route('/')
 def index():
-    page = request.args.get('page', 1, type=int)
-    
-    # Получаем уникальные значения даты создания из базы данных и сортируем их
-    created_at_dates = db.session.query(distinct(Book.created_at)).order_by(Book.created_at.asc()).all()
-    created_at_dates = [date[0] for date in created_at_dates if date[0]]  # Преобразуем в список
-
-    filter_params = {
-        'name': request.args.get('name', ''),
-        'author': request.args.get('author', ''),
-        'genre_ids': request.args.getlist('genre_ids', type=int),
-        'volume_from': request.args.get('volume_from', ''),
-        'volume_to': request.args.get('volume_to', ''),
-        'created_at': request.args.getlist('created_at')  # Параметр для выбранной даты создания
-    }
-
-    books_query = BooksFilter(**filter_params).perform()
-    pagination = books_query.paginate(page, PER_PAGE, error_out=False)
-    books = pagination.items
-    reviews_count = {book.id: len(book.reviews) for book in books}
-    genres = Genre.query.all()
+    filter_params = books_filter_params(request.args)
+
+    pagination = keyset_paginate(*catalogue_query(filter_params), PER_PAGE)
+    cards = book_cards(pagination.items)
+    genres = reference.genres()
+    facets = BookFacets(filter_params).perform()
+    collections, memberships = [], {}
+    if current_user.is_authenticated and current_user.can('show_collections'):
+        collections = db.session.query(Collection.id, Collection.name) \
+            .filter(Collection.user_id == current_user.id) \
+            .order_by(Collection.id.desc()) \
+            .limit(COLLECTIONS_LIMIT) \
+            .all()
+        if collections:
+            memberships = Collection.memberships(current_user.id, [card.id for card in cards])
     
     return render_template('books/index.html',
-                           books=books,
+                           cards=cards,
                            genres=genres,
                            pagination=pagination,
                            search_params=filter_params,
-                           reviews_count=reviews_count,
-                           created_at_dates=created_at_dates)  # Передаем created_at_dates в шаблон
+                           facets=facets,
+                           collections=collections,
+                           memberships=memberships)
 
 @bp.route('/new')
 @login_required
 @permission_check('create')
 def new():
-    genres = Genre.query.all()
+    genres = reference.genres()
     return render_template('books/new.html',
                            genres=genres,
                            book={})
@@ -81,12 +123,18 @@ def new():
 def create():
     f = request.files.get('background_img')
     img = None
+    saver = ImageSaver(f)
     if f and f.filename:
-        img = ImageSaver(f).save()
+        try:
+            img = saver.save()
+        except ImageTooLarge:
+            flash('Размер картинки превышает допустимый', 'danger')
+            return render_template('books/new.html',
+                                   genres=reference.genres(), book={})
 
     try:
-        genres = request.form.getlist('genres')
-        genres = list(map(Genre.query.get, genres))
+        genres = request.form.getlist('genres', type=int)
+        genres = Genre.query.filter(Genre.id.in_(genres)).all() if genres else []
         short_desc = markdown.markdown(bleach.clean(request.form.get('short_desc')))
         book = Book(**params())
         book.genres = genres
@@ -94,8 +142,9 @@ def create():
 
         if not img:
             db.session.rollback()
+            saver.discard()
             flash('Выберите картинку', 'danger')
-            genres = Genre.query.all()
+            genres = reference.genres()
             return render_template('books/new.html',
                                    genres=genres, book=book)
 
@@ -104,19 +153,27 @@ def create():
         for key in BOOK_PARAMS:
             if not getattr(book, key) or not book.short_desc or not book.genres:
                 db.session.rollback()
+                saver.discard()
                 flash('Заполните все поля', 'danger')
-                genres = Genre.query.all()
+                genres = reference.genres()
                 return render_template('books/new.html',
                                        genres=genres, book=book)
 
         db.session.add(book)
-        db.session.commit()
+        db.session.flush()
+        Image.acquire(img.id)
+        SimilarBook.mark_stale([book.id])
+        index_book(book)
+        saver.commit()
+        if not img.variants:
+            schedule_variants(img)
         flash(f'Книга "{book.name}" была успешно добавлена!', 'success')
 
     except sa.exc.SQLAlchemyError:
         db.session.rollback()
+        saver.discard()
         flash(f'При сохранении книги произошла ошибка', 'danger')
-        genres = Genre.query.all()
+        genres = reference.genres()
         return render_template(
             'books/new.html',
             genres=genres,
@@ -135,7 +192,7 @@ def edit(book_id):
         flash(f'Такой книги не существует', 'warning')
         return redirect(url_for('books.index'))
 
-    genres = Genre.query.all()
+    genres = reference.genres()
     return render_template('books/update.html',
                            book=book,
                            genres=genres)
@@ -154,19 +211,22 @@ def update(book_id):
     parametres = params().items()
     print('=' * 30, '\n', parametres)
     try:
-        genres = request.form.getlist('genres')
-        genres = list(map(Genre.query.get, genres))
+        genres = request.form.getlist('genres', type=int)
+        genres = Genre.query.filter(Genre.id.in_(genres)).all() if genres else []
         for key, value in parametres:
             if value:
                 setattr(book, key, value)
+        if {genre.id for genre in book.genres} != {genre.id for genre in genres}:
+            SimilarBook.mark_stale([book.id])
         book.genres = genres
         for key in BOOK_PARAMS:
             if not getattr(book, key) or not book.short_desc or not book.genres:
                 db.session.rollback()
                 flash('Все поля должны быть заполнены', 'danger')
-                genres = Genre.query.all()
+                genres = reference.genres()
                 return render_template('books/update.html',
                                        genres=genres, book=book)
+        index_book(book)
         db.session.commit()
         flash(f'Книга {book.name} была успешно изменена!', 'success')
 
@@ -174,7 +234,7 @@ def update(book_id):
         flash(f'При сохранении книги произошла ошибка', 'danger')
         db.session.rollback()
         book = Book.query.get(book_id)
-        genres = Genre.query.all()
+        genres = reference.genres()
         return render_template('books/update.html',
                                book=book,
                                genres=genres)
@@ -184,29 +244,33 @@ def update(book_id):
 @bp.route('/<int:book_id>')
 @login_required
 def show(book_id):
-    book = Book.query.get(book_id)
+    book = db.session.query(Book.id, Book.name, Book.version, Book.approved_review_count) \
+        .filter(Book.id == book_id) \
+        .first()
 
     if not book:
         flash(f'Такой книги не существует', 'warning')
         return redirect(url_for('books.index'))
 
-    reviews_count = len(book.reviews)
+    page = book_page(book.id, book.version)
+    reviews_count = book.approved_review_count
     user_review = Review()
-    collections = Collection.query.filter_by(user_id=current_user.id)
+    # Подборки пользователя с отметкой, есть ли в них эта книга, одним запросом и не больше COLLECTIONS_LIMIT
+    collections = Collection.for_book(current_user.id, book.id, COLLECTIONS_LIMIT) \
+        if current_user.can('show_collections') else []
     if current_user.is_authenticated:
-        user_review = Review.query.filter_by(user_id=current_user.id).filter_by(book_id=book_id).first()
-    book_reviews = Review.query \
-        .filter_by(book_id=book_id, status_id=REVIEW_STATUSES['APPROVED']['id']) \
-        .order_by(Review.created_at.desc()) \
-        .limit(5) \
-        .all()
+        user_review = own_review_query(current_user.id, book_id).first()
+    book_reviews = latest_reviews_query(book_id).all()
+    similar_books = SimilarBook.for_book(book.id, SIMILAR_SHOWN).all()
     return render_template(
         'books/show.html',
         book=book,
+        page=page,
         review=user_review,
         book_reviews=book_reviews,
         reviews_count=reviews_count,
-        collections=collections
+        collections=collections,
+        similar_books=similar_books
     )
 
 
@@ -220,16 +284,14 @@ def delete(book_id):
         flash(f'Такой книги не существует', 'warning')
         return redirect(url_for('books.index'))
 
-    books_image = Book.query.filter_by(background_image_id=book.bg_image.id).count()
     try:
+        remove_book(book.id)
+        SimilarBook.forget(book.id)
         db.session.delete(book)
+        # Файлы обложки удаляются не здесь, а позже командой flask images sweep:
+        # если транзакция откатится, обложка останется на месте
         if book.background_image_id:
-            if books_image == 1:
-                image = Image.query.get(book.background_image_id)
-                if image:
-                    os.remove(os.path.join(app.app.config['UPLOAD_FOLDER'],
-                                           image.storage_filename))
-                db.session.delete(image)
+            Image.release(book.background_image_id)
         db.session.commit()
         flash(f'Книга "{book.name}" успешно удалена', 'success')
 
@@ -288,24 +350,15 @@ def send_review(book_id):
 @bp.route('/<int:book_id>/reviews')
 @login_required
 def reviews(book_id):
-    page = request.args.get('page', 1, type=int)
-    book_reviews = Review.query.filter_by(book_id=book_id, status_id=REVIEW_STATUSES['APPROVED']['id'])
+    sort_reviews = request.args.get('sort_reviews')
+    dictionary_reviews = {'sort_reviews': sort_reviews, 'book_id': book_id}
+    pagination = keyset_paginate(*book_reviews_query(book_id, sort_reviews), 5)
+    book_reviews = pagination.items
 
-    if not book_reviews.all():
+    if not book_reviews and not pagination.has_prev:
         flash(f'У этой книги еще нет отзывов!', 'warning')
         return redirect(url_for('books.show', book_id=book_id))
 
-    sort_reviews = request.args.get('sort_reviews')
-    dictionary_reviews = {'reviews_filter': sort_reviews, 'book_id': book_id}
-    if sort_reviews == 'positive':
-        book_reviews = book_reviews.order_by(Review.rating.desc())
-    elif sort_reviews == 'negative':
-        book_reviews = book_reviews.order_by(Review.rating.asc())
-    else:
-        book_reviews = book_reviews.order_by(Review.created_at.desc())
-    pagination = book_reviews.paginate(page, 5)
-    book_reviews = pagination.items
-
     return render_template('reviews/reviews.html',
                            book_reviews=book_reviews,
                            book_id=book_id,
@@ -317,20 +370,10 @@ def reviews(book_id):
 @bp.route('/my_reviews')
 @login_required
 def my_reviews():
-    page = request.args.get('page', 1, type=int)
-
-    my_reviews = Review.query.filter_by(user_id=current_user.id)
-
     sort_reviews = request.args.get('sort_reviews')
-    dictionary_reviews = {'reviews_filter': sort_reviews}
-    if sort_reviews == 'positive':
-        book_reviews = my_reviews.order_by(Review.rating.desc())
-    elif sort_reviews == 'negative':
-        book_reviews = my_reviews.order_by(Review.rating.asc())
-    else:
-        book_reviews = my_reviews.order_by(Review.created_at.desc())
-    pagination = book_reviews.paginate(page, 5)
-    my_reviews = pagination.items
+    dictionary_reviews = {'sort_reviews': sort_reviews}
+    pagination = keyset_paginate(*my_reviews_query(current_user.id, sort_reviews), 5)
+    my_reviews = review_views(pagination.items)
 
     return render_template(
         'reviews/my_reviews.html',
@@ -344,20 +387,44 @@ def my_reviews():
 @login_required
 @permission_check('reviews_to_moderate')
 def reviews_to_moderate():
-    page = request.args.get('page', 1, type=int)
-
-    reviews_pagination = Review.query.filter_by(
-        status_id=REVIEW_STATUSES['UNDER_MODERATION']['id']).order_by(Review.created_at.desc()) \
-        .paginate(page=page, per_page=5, error_out=False)
-    reviews = reviews_pagination.items
+    reviews = Review.claim(current_user.id,
+                           app.app.config['MODERATION_BATCH_SIZE'],
+                           app.app.config['MODERATION_LEASE'])
 
     return render_template(
         'reviews/reviews_to_moderate.html',
         reviews=reviews,
-        pagination=reviews_pagination
+        lease_minutes=app.app.config['MODERATION_LEASE'] // 60
     )
 
 
+@bp.route('/reviews_to_moderate', methods=['POST'])
+@login_required
+@permission_check('review')
+def moderate_reviews():
+    review_ids = request.form.getlist('review_ids', type=int)
+    action = request.form.get('action')
+    statuses = {
+        'approve': REVIEW_STATUSES['APPROVED']['id'],
+        'reject': REVIEW_STATUSES['DECLINED']['id'],
+    }
+    if not review_ids or action not in statuses:
+        flash('Выберите рецензии', 'warning')
+        return redirect(url_for('books.reviews_to_moderate'))
+
+    try:
+        changed = Review.moderate_batch(review_ids, statuses[action], current_user.id)
+        if changed is None:
+            flash('Рецензии были изменены другим модератором, повторите действие', 'warning')
+        else:
+            db.session.commit()
+            flash(f'Обработано рецензий: {changed}', 'success')
+    except sa.exc.SQLAlchemyError:
+        db.session.rollback()
+        flash('Произошла ошибка базы данных', 'error')
+    return redirect(url_for('books.reviews_to_moderate'))
+
+
 @bp.route('/review/<int:review_id>', methods=['GET', 'POST'])
 @login_required
 @permission_check('review')
@@ -371,13 +438,14 @@ def review(review_id):
     try:
         if request.method == 'POST':
             action = request.form.get('action')
-            if action == 'approve':
-                review.status_id = 2
-                review.book.rating_up(review.rating)
+            if review.claimed_by_other(current_user.id):
+                flash('Рецензию сейчас рассматривает другой модератор', 'warning')
+            elif action == 'approve':
+                review.change_status(REVIEW_STATUSES['APPROVED']['id'])
                 db.session.commit()
                 flash('Рецензия одобрена', 'success')
             elif action == 'reject':
-                review.status_id = 3
+                review.change_status(REVIEW_STATUSES['DECLINED']['id'])
                 db.session.commit()
                 flash('Рецензия отклонена', 'success')
             return redirect(url_for('books.reviews_to_moderate'))
@@ -386,3 +454,54 @@ def review(review_id):
         return redirect(url_for('books.reviews_to_moderate', review_id=review_id))
 
     return render_template('reviews/review.html', review=review)
+
+
+@bp.cli.command('reindex-search')
+def reindex_search():
+    rebuild_index()
+    click.echo('Поисковый индекс перестроен')
+
+
+@bp.cli.command('backfill-review-counts')
+def backfill_review_counts():
+    Book.backfill_review_counts()
+    click.echo('Счетчики одобренных рецензий пересчитаны')
+
+
+@bp.cli.command('reconcile-ratings')
+@click.option('--chunk-size', default=5000, show_default=True)
+@click.option('--workers', default=4, show_default=True)
+def reconcile_ratings(chunk_size, workers):
+    """Сверить rating_sum/rating_num с одобренными рецензиями и исправить расхождения."""
+    flask_app = app.app
+
+    def reconcile_chunk(start):
+        with flask_app.app_context():
+            try:
+                return Book.reconcile_ratings(start, start + chunk_size)
+            finally:
+                db.session.remove()
+
+    max_id = db.session.query(sa.func.max(Book.id)).scalar() or 0
+    fixed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for drift in pool.map(reconcile_chunk, range(0, max_id + 1, chunk_size)):
+            for book_id, num_drift, sum_drift in drift:
+                click.echo(f'Книга {book_id}: rating_num {num_drift:+}, rating_sum {sum_drift:+}')
+            fixed += len(drift)
+    click.echo(f'Исправлено книг: {fixed}')
+
+
+@bp.cli.command('import')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.option('--covers', type=click.Path(exists=True), help='Каталог или zip-архив с обложками.')
+@click.option('--chunk-size', default=5000, show_default=True)
+@click.option('--workers', type=int, help='Число процессов подготовки записей, по умолчанию по числу ядер.')
+@click.option('--progress-file', type=click.Path(dir_okay=False), help='По умолчанию SOURCE.progress.')
+@click.option('--restart', is_flag=True, help='Начать заново, не учитывая сохраненный прогресс.')
+def import_catalog(source, covers, chunk_size, workers, progress_file, restart):
+    """Импортировать книги из CSV или JSONL (name, author, publishing_house, volume,
+    created_at, short_desc, genres через ";", cover - имя файла обложки)."""
+    progress = import_books(source, covers, chunk_size, workers, progress_file, restart)
+    click.echo(f'Импорт завершен: добавлено книг {progress["imported"]}, пропущено записей {progress["skipped"]}. '
+               f'Уменьшенные копии обложек строит flask images backfill-variants')
@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+# Потокобезопасный LRU-кэш в памяти процесса с необязательным временем жизни записей
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key, MISSING)
+            if item is MISSING:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+# Счетчики версий именованных наборов данных: при изменении данных версия
+# увеличивается, и записи кэша, построенные по старой версии, больше не используются
+class VersionCounter:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        return self.values.get(name, 0)
+
+    def bump(self, name):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + 1
+            return self.values[name]
+
+
+versions = VersionCounter()
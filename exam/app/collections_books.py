@@ -2,11 +2,18 @@ from flask import Blueprint, render_template, request, flash, redirect, url_for
 from flask_login import current_user, login_required
 import sqlalchemy as sa
 
-from app.models import db, Book, Genre, Collection
+from app.models import db, Book, Collection, SimilarBook, book_collection
 from app.auth import permission_check
+from app.pagination import keyset_paginate
+from app import reference
+from app.fragments import book_cards
 
 bp = Blueprint('collections', __name__, url_prefix='/collections')
 
+PER_PAGE = 9
+# Наибольшее число пар (книга, подборка) в одном массовом изменении
+BULK_LIMIT = 1000
+
 
 def get_search_params():
     return {
@@ -15,15 +22,34 @@ def get_search_params():
     }
 
 
+# Возврат на страницу, с которой отправлена форма; допускаются только пути этого сайта
+def _back_url():
+    back = request.form.get('next', '')
+    if back.startswith('/') and not back.startswith('//') and '\\' not in back:
+        return back
+    return url_for('collections.index')
+
+
+# Запросы страниц для keyset_paginate: (запрос, ключи сортировки). Их планы проверяет flask check-plans
+def user_collections_query(user_id):
+    return Collection.query.filter_by(user_id=user_id), [(Collection.id, False)]
+
+
+# Страница подборки листается по ключу (позиция, id книги) индекса связующей таблицы
+def collection_books_query(collection_id):
+    return db.session.query(Book.id, Book.version) \
+        .join(book_collection, book_collection.c['book.id'] == Book.id) \
+        .filter(book_collection.c['collection.id'] == collection_id), \
+        [(book_collection.c.position, False), (book_collection.c['book.id'], False)]
+
+
 @bp.route('/')
 @login_required
 @permission_check('show_collections')
 def index():
-    page = request.args.get('page', 1, type=int)
-    user_id = current_user.id
-    user_collections = Collection.query.filter_by(user_id=user_id).paginate(page, 4)
+    user_collections = keyset_paginate(*user_collections_query(current_user.id), 4)
     collections = user_collections.items
-    books_count = {collection.id: len(collection.books) for collection in collections}
+    books_count = Collection.book_counts([collection.id for collection in collections])
 
     return render_template(
         'collections/index.html',
@@ -66,18 +92,22 @@ def create():
 @login_required
 @permission_check('show_collections')
 def add_book(book_id):
-    collection_id = request.form.get('collection_id')
-    collection = Collection.query.get(collection_id)
-    book = Book.query.get(book_id)
-
-    if not collection or not book:
-        flash('Неверные данные о подборке или книге.', 'danger')
-        return redirect(url_for('books.show', book_id=book_id))
+    collection_id = request.form.get('collection_id', type=int)
+    book = db.session.query(Book.id, Book.name).filter(Book.id == book_id).first()
 
     try:
-        collection.books.append(book)
-        db.session.commit()
-        flash(f'Книга "{book.name}" добавлена в подборку "{collection.name}"!', 'success')
+        collection_ids = Collection.owned(current_user.id, [collection_id])
+        if not collection_ids or not book:
+            db.session.rollback()
+            flash('Неверные данные о подборке или книге.', 'danger')
+            return redirect(url_for('books.show', book_id=book_id))
+
+        if Collection.add_books(collection_ids, [book.id]):
+            db.session.commit()
+            flash(f'Книга "{book.name}" добавлена в подборку!', 'success')
+        else:
+            db.session.rollback()
+            flash(f'Книга "{book.name}" уже есть в этой подборке.', 'warning')
     except sa.exc.SQLAlchemyError:
         db.session.rollback()
         flash('Ошибка при добавлении книги в подборку.', 'danger')
@@ -85,6 +115,45 @@ def add_book(book_id):
     return redirect(url_for('books.show', book_id=book_id))
 
 
+# Добавление или удаление нескольких книг в нескольких подборках одной транзакцией.
+# Все подборки должны принадлежать пользователю, иначе ничего не меняется
+@bp.route('/books', methods=['POST'])
+@login_required
+@permission_check('show_collections')
+def update_books():
+    action = request.form.get('action')
+    collection_ids = sorted(set(request.form.getlist('collection_ids', type=int)))
+    book_ids = sorted(set(request.form.getlist('book_ids', type=int)))
+    back = _back_url()
+
+    if action not in ('add', 'remove') or not collection_ids or not book_ids:
+        flash('Выберите книги и подборки.', 'warning')
+        return redirect(back)
+    if len(collection_ids) * len(book_ids) > BULK_LIMIT:
+        flash(f'За один раз можно изменить не больше {BULK_LIMIT} связей книг с подборками.', 'warning')
+        return redirect(back)
+
+    try:
+        owned = Collection.owned(current_user.id, collection_ids)
+        if len(owned) != len(collection_ids):
+            db.session.rollback()
+            flash('Вы не можете изменять эти подборки.', 'danger')
+            return redirect(back)
+        if action == 'add':
+            changed = Collection.add_books(owned, book_ids)
+            message = f'Добавлено книг в подборки: {changed}'
+        else:
+            changed = Collection.remove_books(owned, book_ids)
+            message = f'Удалено книг из подборок: {changed}'
+        db.session.commit()
+        flash(message, 'success')
+    except sa.exc.SQLAlchemyError:
+        db.session.rollback()
+        flash('Ошибка при изменении подборок.', 'danger')
+
+    return redirect(back)
+
+
 @bp.route('/<int:collection_id>')
 @login_required
 @permission_check('show_collections')
@@ -94,20 +163,44 @@ def show_collection(collection_id):
         flash('Подборка не найдена.', 'danger')
         return redirect(url_for('collections.index'))
 
-    books = collection.books
-    reviews_count = {book.id: len(book.reviews) for book in books}
-    genres = Genre.query.all()
+    books = keyset_paginate(*collection_books_query(collection.id), PER_PAGE)
+    genres = reference.genres()
 
     return render_template(
         'collections/show_collection.html',
         collection=collection,
         genres=genres,
-        books=books,
-        search_params=get_search_params(),
-        reviews_count=reviews_count
+        cards=book_cards(books.items),
+        pagination=books,
+        search_params=get_search_params()
     )
 
 
+@bp.route('/<int:collection_id>/<int:book_id>/move', methods=['POST'])
+@login_required
+@permission_check('show_collections')
+def move_book(collection_id, book_id):
+    collection = Collection.query.get(collection_id)
+    if not collection:
+        flash('Подборка не найдена.', 'danger')
+        return redirect(url_for('collections.index'))
+
+    if collection.user_id != current_user.id:
+        flash('Вы не можете изменять эту подборку.', 'danger')
+        return redirect(url_for('collections.index'))
+
+    direction = -1 if request.form.get('direction') == 'up' else 1
+    try:
+        if Collection.move_book(collection.id, book_id, direction):
+            db.session.commit()
+    except sa.exc.SQLAlchemyError:
+        db.session.rollback()
+        flash('Ошибка при изменении порядка книг.', 'danger')
+
+    return redirect(url_for('collections.show_collection', collection_id=collection.id,
+                            cursor=request.form.get('cursor') or None))
+
+
 @bp.route('/<int:collection_id>/delete', methods=['POST'])
 @login_required
 @permission_check('show_collections')
@@ -122,6 +215,11 @@ def delete_collection(collection_id):
         return redirect(url_for('collections.index'))
 
     try:
+        # Связи удаляются одним запросом, без загрузки книг подборки
+        links = book_collection.c
+        SimilarBook.mark_stale([book_id for book_id, in db.session.query(links['book.id'])
+                                .filter(links['collection.id'] == collection.id)])
+        db.session.execute(book_collection.delete().where(links['collection.id'] == collection.id))
         db.session.delete(collection)
         db.session.commit()
         flash(f'Подборка "{collection.name}" была удалена.', 'success')
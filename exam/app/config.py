@@ -4,6 +4,60 @@ SECRET_KEY = 'secret'
 
 SQLALCHEMY_DATABASE_URI = 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_ECHO = True
+SQLALCHEMY_ECHO = False
+
+# Реплики для чтения: ключи из SQLALCHEMY_BINDS, например
+# SQLALCHEMY_BINDS = {'replica1': 'mysql+mysqlconnector://...@replica1/library'}
+# DB_REPLICA_BINDS = ['replica1']
+# GET-запросы читают со случайной реплики, отстающей не больше DB_REPLICA_MAX_LAG секунд,
+# а пользователь, который что-то изменил, DB_READ_YOUR_WRITES секунд читает из основной базы.
+# Локально вместо реплики подойдет копия файла SQLite
+SQLALCHEMY_BINDS = {}
+DB_REPLICA_BINDS = []
+DB_REPLICA_MAX_LAG = 5
+DB_REPLICA_CHECK_INTERVAL = 10
+DB_READ_YOUR_WRITES = 15
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media', 'images')
+# Хранилище изображений: 'local' (UPLOAD_FOLDER) или 's3' (нужен boto3).
+# Для S3-совместимых серверов (MinIO, moto_server) указывается IMAGE_STORAGE_S3_ENDPOINT
+IMAGE_STORAGE = 'local'
+IMAGE_STORAGE_S3_BUCKET = None
+IMAGE_STORAGE_S3_PREFIX = 'images/'
+IMAGE_STORAGE_S3_ENDPOINT = None
+
+# Срок кэширования обложек браузером и прокси, в секундах
+IMAGE_MAX_AGE = 31536000
+
+# Ограничение размера загружаемой обложки и всего запроса с формой книги
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+MAX_CONTENT_LENGTH = MAX_IMAGE_SIZE + 1024 * 1024
+
+# Уменьшенные копии обложек: ширины, форматы и число процессов для их построения
+IMAGE_VARIANT_WIDTHS = [300, 600]
+IMAGE_VARIANT_FORMATS = ['webp', 'jpeg']
+IMAGE_VARIANT_WORKERS = 2
+IMAGE_PENDING_MAX_AGE = 60
+
+# Сколько секунд ждать, прежде чем удалять изображение без книг (flask images sweep)
+# или файл без строки в images (flask images gc): за это время завершаются начатые загрузки
+IMAGE_GC_GRACE = 3600
+
+# Сколько похожих книг хранится для каждой книги (flask similar rebuild)
+SIMILAR_BOOKS_K = 10
+
+# Кэш фрагментов: размер LRU в памяти процесса и необязательный общий уровень (redis://...)
+FRAGMENT_CACHE_SIZE = 4096
+FRAGMENT_CACHE_URL = None
+FRAGMENT_CACHE_TTL = 86400
+
+# Очередь модерации: сколько рецензий выдается модератору и на сколько секунд
+MODERATION_BATCH_SIZE = 20
+MODERATION_LEASE = 900
+
+# Статистика SQL по запросам: заголовок Server-Timing, предупреждения о N+1 в логе
+# и страница /debug/sql для администраторов. Запрос, повторенный за один HTTP-запрос
+# SQL_STATS_REPEAT_THRESHOLD раз и больше, считается признаком N+1
+SQL_STATS = False
+SQL_STATS_REPEAT_THRESHOLD = 5
+SQL_STATS_HISTORY = 100
@@ -36,10 +36,13 @@ DROP TABLE IF EXISTS `book_collection`;
 /*!40101 SET @saved_cs_client     = @@character_set_client */;
 /*!50503 SET character_set_client = utf8mb4 */;
 CREATE TABLE `book_collection` (
-  `book.id` int(11) DEFAULT NULL,
-  `collection.id` int(11) DEFAULT NULL,
-  UNIQUE KEY `fk_book_collection_collection.id_collections` (`collection.id`) USING BTREE,
-  KEY `fk_book_collection_book.id_books` (`book.id`),
+  `book.id` int(11) NOT NULL,
+  `collection.id` int(11) NOT NULL,
+  `position` int(11) NOT NULL DEFAULT '0',
+  `added_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`book.id`,`collection.id`),
+  KEY `ix_book_collection_collection_id` (`collection.id`,`book.id`),
+  KEY `ix_book_collection_collection_id_position` (`collection.id`,`position`,`book.id`),
   CONSTRAINT `fk_book_collection_book.id_books` FOREIGN KEY (`book.id`) REFERENCES `books` (`id`),
   CONSTRAINT `fk_book_collection_collection.id_collections` FOREIGN KEY (`collection.id`) REFERENCES `collections` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
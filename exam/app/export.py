@@ -0,0 +1,177 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+
+import click
+from flask import Blueprint, Response, request, stream_with_context, abort
+from flask_login import login_required
+from werkzeug.datastructures import MultiDict
+
+from app import reference
+from app.auth import permission_check
+from app.constants import REVIEW_STATUSES
+from app.models import db, Book, Review, Collection, book_genre, book_collection
+from app.tools import BooksFilter, books_filter_params
+
+bp = Blueprint('export', __name__, url_prefix='/export')
+
+# Строки читаются пачками по BATCH_SIZE по ключу id, после каждого окна из WINDOW_SIZE строк
+# транзакция завершается, чтобы выгрузка не держала снимок и блокировки
+BATCH_SIZE = 1000
+WINDOW_SIZE = 20000
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+# convert дополняет пачку строк (не больше BATCH_SIZE) на месте
+Dataset = namedtuple('Dataset', 'columns query convert')
+
+
+# Связанные id для строк пачки: {id строки: [id, ...]} в порядке order_by.
+# Связи читаются отдельным запросом и группируются здесь, а не GROUP_CONCAT в SQL:
+# в MySQL его результат молча обрезается по group_concat_max_len
+def _linked(rows, owner, value, *order_by):
+    linked = {row['id']: [] for row in rows}
+    if linked:
+        links = db.session.query(owner, value) \
+            .filter(owner.in_(list(linked))) \
+            .order_by(owner, *order_by) \
+            .yield_per(BATCH_SIZE)
+        for owner_id, value_id in links:
+            linked[owner_id].append(value_id)
+    return linked
+
+
+def books_dataset(args):
+    query = BooksFilter(**books_filter_params(args)).query.with_entities(
+        Book.id, Book.name, Book.author, Book.publishing_house, Book.volume, Book.created_at,
+        Book.rating_num, Book.rating_sum, Book.approved_review_count)
+
+    def convert(rows):
+        genres = _linked(rows, book_genre.c['book.id'], book_genre.c['genre.id'], book_genre.c['genre.id'])
+        for row in rows:
+            row['genres'] = ';'.join(reference.genre(genre_id).name for genre_id in genres[row['id']])
+
+    return Dataset(
+        ('id', 'name', 'author', 'publishing_house', 'volume', 'created_at',
+         'rating_num', 'rating_sum', 'approved_review_count', 'genres'),
+        query, convert)
+
+
+def reviews_dataset(args):
+    query = db.session.query(
+        Review.id, Review.book_id, Review.user_id, Review.rating, Review.text, Review.created_at) \
+        .filter(Review.status_id == REVIEW_STATUSES['APPROVED']['id'])
+    if args.get('book_id', type=int):
+        query = query.filter(Review.book_id == args.get('book_id', type=int))
+    return Dataset(('id', 'book_id', 'user_id', 'rating', 'text', 'created_at'), query, None)
+
+
+def collections_dataset(args):
+    query = db.session.query(Collection.id, Collection.name, Collection.desc, Collection.user_id)
+
+    # Книги в порядке подборки, как на ее странице и в API
+    def convert(rows):
+        book_ids = _linked(rows, book_collection.c['collection.id'], book_collection.c['book.id'],
+                           book_collection.c.position, book_collection.c['book.id'])
+        for row in rows:
+            row['book_ids'] = ';'.join(str(book_id) for book_id in book_ids[row['id']])
+
+    return Dataset(('id', 'name', 'desc', 'user_id', 'book_ids'), query, convert)
+
+
+DATASETS = {
+    'books': (books_dataset, Book.id),
+    'reviews': (reviews_dataset, Review.id),
+    'collections': (collections_dataset, Collection.id),
+}
+
+
+# Строки по возрастанию id, начиная после after_id; по этому id выгрузку можно продолжить.
+# Пачка читается целиком и только потом дополняется связями: пока открыт потоковый
+# курсор, MySQL не даст выполнить на том же соединении второй запрос
+def iter_rows(dataset, id_column, after_id=None):
+    last_id = after_id
+    in_window = 0
+    while True:
+        query = dataset.query
+        if last_id is not None:
+            query = query.filter(id_column > last_id)
+        rows = [dict(row._mapping) for row in query.order_by(id_column).limit(BATCH_SIZE)]
+        if rows and dataset.convert:
+            dataset.convert(rows)
+        yield from rows
+        in_window += len(rows)
+        if len(rows) < BATCH_SIZE:
+            db.session.commit()
+            return
+        last_id = rows[-1]['id']
+        if in_window >= WINDOW_SIZE:
+            db.session.commit()
+            in_window = 0
+
+
+def _value(value):
+    return value.isoformat(sep=' ') if isinstance(value, datetime) else value
+
+
+# Текст выгрузки кусками примерно по BATCH_SIZE строк
+def render(name, fmt, args, after_id=None):
+    make_dataset, id_column = DATASETS[name]
+    dataset = make_dataset(args)
+    rows = iter_rows(dataset, id_column, after_id)
+    if fmt == 'jsonl':
+        lines = []
+        for row in rows:
+            lines.append(json.dumps({key: _value(row[key]) for key in dataset.columns}, ensure_ascii=False) + '\n')
+            if len(lines) >= BATCH_SIZE:
+                yield ''.join(lines)
+                lines = []
+        yield ''.join(lines)
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(dataset.columns)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([_value(row[key]) for key in dataset.columns])
+        if i % BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@bp.route('/<name>.<fmt>')
+@login_required
+@permission_check('export')
+def export(name, fmt):
+    if name not in DATASETS or fmt not in FORMATS:
+        abort(404)
+    chunks = render(name, fmt, request.args, request.args.get('after_id', type=int))
+    response = Response(stream_with_context(chunks), mimetype=FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
+
+
+def _register_command(name):
+    @bp.cli.command(name)
+    @click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='jsonl', show_default=True)
+    @click.option('--after-id', type=int, help='Продолжить выгрузку после этого id.')
+    @click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-')
+    @click.option('--filter', 'filters', multiple=True, metavar='KEY=VALUE',
+                  help='Фильтры как в каталоге: name=..., genre_ids=3, year_from=2000.')
+    def command(fmt, after_id, output, filters):
+        args = MultiDict(item.split('=', 1) for item in filters)
+        for chunk in render(name, fmt, args, after_id):
+            output.write(chunk)
+        output.flush()
+
+    command.__doc__ = f'Выгрузить {name} в CSV или JSONL.'
+
+
+for _name in DATASETS:
+    _register_command(_name)
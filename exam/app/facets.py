@@ -0,0 +1,67 @@
+import sqlalchemy as sa
+
+from app.cache import LRUCache, versions
+from app.models import db, Book, book_genre
+from app.tools import BooksFilter
+
+# Снимки фасетов живут до первого изменения каталога, но не дольше FACETS_TTL секунд:
+# версия сбрасывается только в текущем процессе, остальные процессы догонят по TTL
+FACETS_TTL = 60
+snapshots = LRUCache(maxsize=1024, ttl=FACETS_TTL)
+
+FACET_GENRE = 'genre'
+FACET_YEAR = 'year'
+
+
+def _cache_key(filter_params):
+    items = []
+    for key, value in sorted(filter_params.items()):
+        if isinstance(value, list):
+            value = tuple(sorted(value))
+        items.append((key, value))
+    return (versions.get('books'), tuple(items))
+
+
+# Количество книг по каждому жанру и году для текущего состояния фильтра.
+# Счетчик жанра не учитывает выбранные жанры, а счетчик года - выбранные годы,
+# чтобы в боковой панели было видно, сколько книг добавит соседний вариант.
+class BookFacets:
+    def __init__(self, filter_params):
+        self.filter_params = filter_params
+        self.genres = {}
+        self.years = {}
+
+    def _ids(self, **excluded):
+        params = dict(self.filter_params, **excluded)
+        return BooksFilter(**params).query.with_entities(Book.id).order_by(None).subquery()
+
+    def perform(self):
+        genres, years = snapshots.get_or_set(_cache_key(self.filter_params), self._aggregate)
+        self.genres = genres
+        # Выбранные годы остаются в списке, даже если по остальным условиям книг нет
+        selected = self.filter_params.get('created_at') or []
+        self.years = dict(sorted({**dict.fromkeys(selected, 0), **years}.items()))
+        return self
+
+    def _aggregate(self):
+        genre_ids = self._ids(genre_ids=None)
+        year_ids = self._ids(created_at=None, year_from=None, year_to=None)
+        genre_id = book_genre.c['genre.id']
+        by_genre = sa.select(sa.literal(FACET_GENRE), genre_id, sa.func.count()) \
+            .where(book_genre.c['book.id'].in_(sa.select(genre_ids.c.id))) \
+            .group_by(genre_id)
+        by_year = sa.select(sa.literal(FACET_YEAR), Book.year, sa.func.count()) \
+            .where(Book.id.in_(sa.select(year_ids.c.id)), Book.year.isnot(None)) \
+            .group_by(Book.year)
+
+        genres, years = {}, {}
+        for facet, value, count in db.session.execute(sa.union_all(by_genre, by_year)):
+            (genres if facet == FACET_GENRE else years)[value] = count
+        return genres, dict(sorted(years.items()))
+
+
+@sa.event.listens_for(Book, 'after_insert')
+@sa.event.listens_for(Book, 'after_update')
+@sa.event.listens_for(Book, 'after_delete')
+def book_changed(mapper, connection, target):
+    versions.bump('books')
@@ -0,0 +1,119 @@
+import json
+from collections import namedtuple
+
+from flask import render_template
+from markupsafe import Markup
+from sqlalchemy.orm import selectinload
+
+from app.cache import LRUCache
+from app.models import Book
+from app.viewmodels import book_card_views
+
+# Место во фрагменте, куда при выводе подставляется часть, зависящая от пользователя
+SLOT = '<!-- fragment-slot -->'
+
+BookCard = namedtuple('BookCard', 'id name html')
+BookPage = namedtuple('BookPage', 'header about')
+
+
+# Общий для всех процессов уровень кэша на Redis, подключается через FRAGMENT_CACHE_URL
+class RedisBackend:
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get_many(self, keys):
+        values = self.client.mget(keys)
+        return {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, mapping):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipeline.setex(key, self.ttl, json.dumps(value))
+        pipeline.execute()
+
+
+# Кэш отрендеренных фрагментов: ограниченный LRU в памяти процесса и необязательный общий уровень.
+# Ключ содержит версию книги, поэтому после изменения книги старые фрагменты просто перестают читаться.
+class FragmentCache:
+    def __init__(self, maxsize=4096, backend=None):
+        self.local = LRUCache(maxsize)
+        self.backend = backend
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.local.get(key)
+            if value is not None:
+                found[key] = value
+        missing = [key for key in keys if key not in found]
+        if missing and self.backend is not None:
+            for key, value in self.backend.get_many(missing).items():
+                self.local.set(key, value)
+                found[key] = value
+        return found
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.local.set(key, value)
+        if self.backend is not None and mapping:
+            self.backend.set_many(mapping)
+
+
+fragments = FragmentCache()
+
+
+def init_fragment_cache(app):
+    fragments.local = LRUCache(app.config.get('FRAGMENT_CACHE_SIZE', 4096))
+    url = app.config.get('FRAGMENT_CACHE_URL')
+    if url:
+        fragments.backend = RedisBackend(url, app.config.get('FRAGMENT_CACHE_TTL', 86400))
+    app.add_template_filter(fill_slot)
+    app.add_template_global(Markup(SLOT), 'fragment_slot')
+
+
+def fill_slot(fragment, content):
+    return Markup(fragment).replace(Markup(SLOT), Markup(content))
+
+
+def card_key(book_id, version):
+    return f'book-card:{book_id}:{version}'
+
+
+def page_key(book_id, version):
+    return f'book-page:{book_id}:{version}'
+
+
+# Карточки каталога для строк (id, version); для промахов кэша данные карточек
+# загружаются двумя запросами независимо от числа книг на странице
+def book_cards(rows):
+    keys = {book_id: card_key(book_id, version) for book_id, version in rows}
+    found = fragments.get_many(list(keys.values()))
+    missing = [book_id for book_id, key in keys.items() if key not in found]
+    if missing:
+        rendered = {}
+        for book in book_card_views(missing):
+            key = card_key(book.id, book.version)
+            rendered[key] = [book.name, render_template('books/card.html', book=book)]
+            keys[book.id] = key
+        fragments.set_many(rendered)
+        found.update(rendered)
+    return [BookCard(book_id, found[key][0], Markup(found[key][1]))
+            for book_id, key in keys.items() if key in found]
+
+
+# Неизменная для всех пользователей часть страницы книги
+def book_page(book_id, version):
+    key = page_key(book_id, version)
+    found = fragments.get_many([key])
+    if key not in found:
+        book = Book.query.options(selectinload(Book.genres)).get(book_id)
+        if book is None:
+            return None
+        key = page_key(book.id, book.version)
+        found[key] = [render_template('books/show_header.html', book=book),
+                      render_template('books/show_about.html', book=book)]
+        fragments.set_many({key: found[key]})
+    header, about = found[key]
+    return BookPage(Markup(header), Markup(about))
@@ -0,0 +1,206 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import sqlalchemy as sa
+from sqlalchemy.orm import selectinload
+
+from app.models import db, Book, Image, ImageVariant
+from app.storage import storage, shard_key
+from app.tools import forget_image
+from app.variants import forget_variants
+
+# Имя файла хранилища начинается с id изображения: <uuid>.jpg у оригинала, <uuid>-300.webp у вариантов
+IMAGE_FILE = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+SHARDS = [f'{i:02x}' for i in range(256)]
+SPOOL_PREFIXES = ('.upload-', '.variants-')
+
+
+def _grace(grace):
+    return current_app.config['IMAGE_GC_GRACE'] if grace is None else grace
+
+
+# Каталоги первого уровня, которые обрабатывает запуск номер index из count.
+# Файлы в корне хранилища достаются первому запуску
+def shard_names(index, count):
+    shards = [shard for shard in SHARDS if int(shard, 16) % count == index]
+    return ([None] if index == 0 else []) + shards
+
+
+def _parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise click.BadParameter('ожидается номер/всего, например 0/4')
+    if count < 1 or not 0 <= index < count:
+        raise click.BadParameter('номер должен быть от 0 до всего - 1')
+    return index, count
+
+
+# Изображения без книг, отпущенные раньше cutoff. Строки блокируются, а занятые другим
+# запуском или загрузкой пропускаются, поэтому sweep можно запускать в несколько процессов
+def released_images(cutoff, last_id, batch_size):
+    referenced = sa.exists().where(Book.background_image_id == Image.id)
+    return Image.query.options(selectinload(Image.variants)) \
+        .filter(Image.id > last_id,
+                Image.ref_count <= 0,
+                sa.func.coalesce(Image.released_at, Image.created_at) < cutoff,
+                ~referenced) \
+        .order_by(Image.id) \
+        .limit(batch_size) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+
+def _delete_files(pool, keys):
+    list(pool.map(storage().delete, keys))
+
+
+@click.command('sweep')
+@click.option('--grace', type=int, help='Сколько секунд изображение должно пробыть без книг; '
+                                         'по умолчанию IMAGE_GC_GRACE.')
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--workers', default=8, show_default=True, help='Потоков для удаления файлов.')
+@click.option('--dry-run', is_flag=True, help='Только показать, что будет удалено.')
+@with_appcontext
+def sweep(grace, batch_size, workers, dry_run):
+    """Удалить изображения, на которые больше не ссылается ни одна книга.
+
+    Строка изображения удаляется раньше файлов: если удаление файла не удастся,
+    его потом найдет flask images gc.
+    """
+    cutoff = datetime.now() - timedelta(seconds=_grace(grace))
+    stats = Counter()
+    last_id = ''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            images = released_images(cutoff, last_id, batch_size)
+            if not images:
+                break
+            last_id = images[-1].id
+            ids = [img.id for img in images]
+            keys = []
+            for img in images:
+                keys.append(img.storage_key)
+                keys.extend(shard_key(img.md5_hash, variant.file_name) for variant in img.variants)
+            if dry_run:
+                db.session.rollback()
+                for key in keys:
+                    click.echo(key)
+            else:
+                ImageVariant.query.filter(ImageVariant.image_id.in_(ids)).delete(synchronize_session=False)
+                Image.query.filter(Image.id.in_(ids), Image.ref_count <= 0).delete(synchronize_session=False)
+                db.session.commit()
+                _delete_files(pool, keys)
+                for image_id in ids:
+                    forget_image(image_id)
+                    forget_variants(image_id)
+            db.session.expunge_all()
+            stats['images'] += len(ids)
+            stats['files'] += len(keys)
+    action = 'Будет удалено' if dry_run else 'Удалено'
+    click.echo(f'{action} изображений: {stats["images"]}, файлов: {stats["files"]}')
+
+
+# Какие из имен файлов принадлежат существующим изображениям и их вариантам
+def live_names(names):
+    ids = {match.group(1) for match in map(IMAGE_FILE.match, names) if match}
+    if not ids:
+        return set()
+    live = {image_id + os.path.splitext(file_name)[1] for image_id, file_name in
+            db.session.query(Image.id, Image.file_name).filter(Image.id.in_(ids))}
+    live.update(file_name for file_name, in
+                db.session.query(ImageVariant.file_name).filter(ImageVariant.image_id.in_(ids)))
+    db.session.rollback()
+    return live
+
+
+def _collect(batch, cutoff, stats):
+    names = [key.rsplit('/', 1)[-1] for key, _ in batch]
+    live = live_names(names)
+    orphans = []
+    for (key, modified), name in zip(batch, names):
+        if name in live:
+            stats['live'] += 1
+        elif not IMAGE_FILE.match(name):
+            stats['unknown'] += 1
+        elif modified >= cutoff:
+            # Файл мог быть только что записан загрузкой, строка которой еще не зафиксирована
+            stats['recent'] += 1
+        else:
+            orphans.append(key)
+    return orphans
+
+
+# Брошенные временные файлы загрузок и каталоги построения вариантов
+def stale_spool(cutoff):
+    spool_dir = storage().spool_dir or tempfile.gettempdir()
+    removed = 0
+    with os.scandir(spool_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith(SPOOL_PREFIXES) or entry.stat().st_mtime >= cutoff:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+            removed += 1
+    return removed
+
+
+@click.command('gc')
+@click.option('--grace', type=int, help='Файлы моложе стольких секунд не трогаются; по умолчанию IMAGE_GC_GRACE.')
+@click.option('--shard', default='0/1', show_default=True,
+              help='Часть хранилища для этого запуска: номер/всего. Запуски с разными номерами не пересекаются.')
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--workers', default=8, show_default=True, help='Потоков для удаления файлов.')
+@click.option('--dry-run', is_flag=True, help='Только показать, что будет удалено.')
+@with_appcontext
+def gc(grace, shard, batch_size, workers, dry_run):
+    """Удалить файлы хранилища, которых нет в таблице images.
+
+    Хранилище просматривается потоком пачками по batch-size файлов, и для каждой пачки
+    одним запросом проверяется, каким изображениям и вариантам принадлежат файлы.
+    Новые файлы не удаляются, поэтому команда безопасна во время загрузок.
+    """
+    index, count = _parse_shard(shard)
+    cutoff = time.time() - _grace(grace)
+    stats = Counter()
+
+    def reclaim(pool, batch):
+        orphans = _collect(batch, cutoff, stats)
+        stats['orphans'] += len(orphans)
+        if dry_run:
+            for key in orphans:
+                click.echo(key)
+        else:
+            _delete_files(pool, orphans)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for name in shard_names(index, count):
+            for item in storage().iter_files(name):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    reclaim(pool, batch)
+                    batch = []
+        if batch:
+            reclaim(pool, batch)
+    if index == 0 and not dry_run:
+        stats['spool'] = stale_spool(cutoff)
+
+    action = 'Будет удалено' if dry_run else 'Удалено'
+    click.echo(f'{action} файлов без изображений: {stats["orphans"]}, используется: {stats["live"]}, '
+               f'новых: {stats["recent"]}, с чужими именами: {stats["unknown"]}, '
+               f'временных: {stats["spool"]}')
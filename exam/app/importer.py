@@ -0,0 +1,277 @@
+import csv
+import hashlib
+import json
+import mimetypes
+import os
+import time
+import uuid
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bleach
+import click
+import markdown
+import sqlalchemy as sa
+from werkzeug.utils import secure_filename
+
+from app import reference
+from app.cache import versions
+from app.models import db, Book, Image, SimilarBook, book_genre
+from app.search import index_books
+from app.storage import storage, shard_key, make_spool_dir
+
+REQUIRED_FIELDS = ('name', 'author', 'publishing_house', 'volume', 'created_at', 'short_desc')
+CHUNK_SIZE = 64 * 1024
+
+
+class ImportRecordError(Exception):
+    pass
+
+
+# Состояние рабочего процесса: источник обложек, уже скопированные обложки,
+# конвертер markdown и очиститель HTML (их создание дороже самой обработки описания)
+_covers = None
+_spool_dir = None
+_spooled = {}
+_markdown = None
+_cleaner = None
+
+
+class CoverSource:
+    def __init__(self, path):
+        self.path = path
+        self.archive = None if os.path.isdir(path) else zipfile.ZipFile(path)
+
+    def open(self, name):
+        if self.archive is not None:
+            return self.archive.open(name)
+        return open(os.path.join(self.path, name), 'rb')
+
+
+def init_worker(covers, spool_dir):
+    global _covers, _spool_dir, _markdown, _cleaner
+    _covers = CoverSource(covers) if covers else None
+    _spool_dir = spool_dir
+    _markdown = markdown.Markdown()
+    _cleaner = bleach.Cleaner()
+
+
+# Копирует обложку во временный каталог, одновременно считая md5. Файл получает имя по хэшу,
+# поэтому одна и та же обложка у разных книг и в разных процессах хранится один раз
+def spool_cover(name):
+    spooled = _spooled.get(name)
+    if spooled is not None and os.path.exists(spooled[1]):
+        return spooled
+    md5 = hashlib.md5()
+    tmp_path = os.path.join(_spool_dir, f'.{uuid.uuid4()}')
+    with _covers.open(name) as source, open(tmp_path, 'wb') as out:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            out.write(chunk)
+    md5_hash = md5.hexdigest()
+    path = os.path.join(_spool_dir, md5_hash)
+    os.replace(tmp_path, path)
+    _spooled[name] = (md5_hash, path)
+    return md5_hash, path
+
+
+# Выполняется в рабочем процессе: проверка полей, очистка описания и подготовка обложки
+def prepare(record):
+    line, fields = record
+    try:
+        if isinstance(fields, ImportRecordError):
+            raise fields
+        if not isinstance(fields, dict):
+            raise ImportRecordError('запись должна быть объектом')
+        missing = [field for field in REQUIRED_FIELDS if not str(fields.get(field) or '').strip()]
+        if missing:
+            raise ImportRecordError('не заполнены поля ' + ', '.join(missing))
+        created_at = str(fields['created_at']).strip()
+        if not (len(created_at) == 4 and created_at.isdigit()):
+            raise ImportRecordError('год издания должен состоять из 4 цифр')
+        genres = fields.get('genres') or []
+        if isinstance(genres, str):
+            genres = genres.split(';')
+        elif not isinstance(genres, list):
+            raise ImportRecordError('жанры должны быть строкой или списком')
+        genres = [str(genre).strip() for genre in genres if str(genre).strip()]
+        book = {
+            'name': str(fields['name']).strip(),
+            'author': str(fields['author']).strip(),
+            'publishing_house': str(fields['publishing_house']).strip(),
+            'volume': int(fields['volume']),
+            'created_at': created_at,
+            'year': int(created_at),
+            'short_desc': _markdown.reset().convert(_cleaner.clean(str(fields['short_desc']))),
+        }
+        cover = None
+        if fields.get('cover'):
+            if _covers is None:
+                raise ImportRecordError('не указан источник обложек')
+            mime_type = mimetypes.guess_type(fields['cover'])[0]
+            if not mime_type or not mime_type.startswith('image/'):
+                raise ImportRecordError(f'обложка {fields["cover"]} не является изображением')
+            md5_hash, path = spool_cover(fields['cover'])
+            cover = {'md5_hash': md5_hash, 'path': path, 'mime_type': mime_type,
+                     'file_name': secure_filename(os.path.basename(fields['cover']))}
+        return {'line': line, 'book': book, 'genres': genres, 'cover': cover}
+    except (ImportRecordError, ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+        return {'line': line, 'error': str(e)}
+
+
+# Строка JSONL, которая не разбирается, передается дальше как ошибка, чтобы ее пропустил prepare
+def read_records(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.jsonl'):
+            for line, text in enumerate(f, 1):
+                if text.strip():
+                    try:
+                        yield line, json.loads(text)
+                    except json.JSONDecodeError as e:
+                        yield line, ImportRecordError(f'некорректный JSON: {e}')
+        else:
+            for line, row in enumerate(csv.DictReader(f), 2):
+                yield line, row
+
+
+def resolve_genres(names):
+    ids = []
+    for name in names:
+        genre = reference.genre_by_name(name)
+        if genre is None and str(name).isdigit():
+            genre = reference.genre(int(name))
+        if genre is None:
+            raise ImportRecordError(f'неизвестный жанр {name}')
+        ids.append(genre.id)
+    return sorted(set(ids))
+
+
+# Записывает пачку книг одной транзакцией: изображения, книги и связи с жанрами вставляются
+# через executemany, id книг назначаются заранее от текущего максимума
+def store_chunk(prepared, io_pool):
+    hashes = {item['cover']['md5_hash'] for item in prepared if item['cover']}
+    # Найденные изображения блокируются, чтобы flask images sweep не удалил их до фиксации
+    images = dict(db.session.query(Image.md5_hash, Image.id).filter(Image.md5_hash.in_(hashes)).with_for_update()) \
+        if hashes else {}
+    new_images = {}
+    for item in prepared:
+        cover = item['cover']
+        if cover and cover['md5_hash'] not in images and cover['md5_hash'] not in new_images:
+            new_images[cover['md5_hash']] = dict(cover, id=str(uuid.uuid4()))
+
+    next_id = (db.session.query(sa.func.max(Book.id)).scalar() or 0) + 1
+    books, links = [], []
+    refs = Counter()
+    for book_id, item in enumerate(prepared, next_id):
+        cover = item['cover']
+        image_id = None
+        if cover:
+            image_id = images.get(cover['md5_hash']) or new_images[cover['md5_hash']]['id']
+            refs[image_id] += 1
+        books.append(dict(item['book'], id=book_id, background_image_id=image_id))
+        links.extend({'book.id': book_id, 'genre.id': genre_id} for genre_id in item['genre_ids'])
+
+    store = storage()
+    stored = []
+    try:
+        if new_images:
+            db.session.execute(Image.__table__.insert(), [
+                {'id': image['id'], 'file_name': image['file_name'],
+                 'mime_type': image['mime_type'], 'md5_hash': image['md5_hash']}
+                for image in new_images.values()])
+        db.session.execute(Book.__table__.insert(), books)
+        SimilarBook.mark_stale([book['id'] for book in books])
+        if refs:
+            image_table = Image.__table__
+            db.session.execute(
+                image_table.update()
+                .where(image_table.c.id == sa.bindparam('image_id'))
+                .values(ref_count=image_table.c.ref_count + sa.bindparam('refs'), released_at=None),
+                [{'image_id': image_id, 'refs': count} for image_id, count in refs.items()])
+        if links:
+            db.session.execute(book_genre.insert(), links)
+        index_books((book['id'], book['name'], book['author']) for book in books)
+
+        def put(image):
+            _, ext = os.path.splitext(image['file_name'])
+            key = shard_key(image['md5_hash'], image['id'] + ext)
+            store.copy_file(image['path'], key, image['mime_type'])
+            return key
+
+        stored.extend(io_pool.map(put, new_images.values()))
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        for key in stored:
+            store.delete(key)
+        raise
+    return len(books)
+
+
+def load_progress(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'position': 0, 'imported': 0, 'skipped': 0}
+
+
+def save_progress(path, progress):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+
+def import_books(source, covers=None, chunk_size=5000, workers=None, progress_path=None, restart=False):
+    progress_path = progress_path or f'{source}.progress'
+    progress = {'position': 0, 'imported': 0, 'skipped': 0} if restart else load_progress(progress_path)
+    if progress['position']:
+        click.echo(f'Продолжение с записи {progress["position"] + 1}')
+
+    spool_dir = make_spool_dir('.import-')
+    started = time.monotonic()
+    done_at_start = progress['imported'] + progress['skipped']
+    records = read_records(source)
+    for _ in range(progress['position']):
+        next(records, None)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(covers, spool_dir)) as pool, \
+            ThreadPoolExecutor(max_workers=8) as io_pool:
+        while True:
+            chunk = [record for _, record in zip(range(chunk_size), records)]
+            if not chunk:
+                break
+            prepared = []
+            for item in pool.map(prepare, chunk, chunksize=max(1, chunk_size // (4 * (workers or os.cpu_count() or 1)))):
+                if 'error' not in item:
+                    try:
+                        item['genre_ids'] = resolve_genres(item['genres'])
+                    except (ImportRecordError, TypeError) as e:
+                        item = {'line': item['line'], 'error': str(e)}
+                if 'error' in item:
+                    click.echo(f'Строка {item["line"]}: {item["error"]}', err=True)
+                    progress['skipped'] += 1
+                else:
+                    prepared.append(item)
+
+            for attempt in range(3):
+                try:
+                    progress['imported'] += store_chunk(prepared, io_pool) if prepared else 0
+                    break
+                except sa.exc.IntegrityError:
+                    # Параллельно с импортом книги или обложки добавили через сайт: id и хэши перечитываются
+                    if attempt == 2:
+                        raise
+            progress['position'] += len(chunk)
+            save_progress(progress_path, progress)
+            versions.bump('books')
+
+            for name in os.listdir(spool_dir):
+                os.remove(os.path.join(spool_dir, name))
+            elapsed = time.monotonic() - started
+            rate = (progress['imported'] + progress['skipped'] - done_at_start) / elapsed if elapsed else 0
+            click.echo(f'Импортировано: {progress["imported"]}, пропущено: {progress["skipped"]}, '
+                       f'{rate:.0f} записей/с')
+    os.rmdir(spool_dir)
+    return progress
@@ -0,0 +1,40 @@
+"""books fulltext search
+
+Revision ID: c2b7f4e91a05
+Revises: 8ddf71f6c4af
+Create Date: 2026-10-17 10:12:41.530211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2b7f4e91a05'
+down_revision = '8ddf71f6c4af'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'mysql':
+        op.create_index('ix_books_name_fulltext', 'books', ['name'], unique=False, mysql_prefix='FULLTEXT')
+        op.create_index('ix_books_author_fulltext', 'books', ['author'], unique=False, mysql_prefix='FULLTEXT')
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE books_fts "
+            "USING fts5(name, author, tokenize='unicode61 remove_diacritics 2')")
+        op.execute(
+            "INSERT INTO books_fts (rowid, name, author) "
+            "SELECT id, replace(replace(name, 'Ё', 'Е'), 'ё', 'е'), replace(replace(author, 'Ё', 'Е'), 'ё', 'е') "
+            "FROM books")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'mysql':
+        op.drop_index('ix_books_author_fulltext', table_name='books')
+        op.drop_index('ix_books_name_fulltext', table_name='books')
+    elif dialect == 'sqlite':
+        op.execute('DROP TABLE books_fts')
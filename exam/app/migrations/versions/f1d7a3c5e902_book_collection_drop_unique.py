@@ -0,0 +1,33 @@
+"""book_collection drop unique collection id
+
+Revision ID: f1d7a3c5e902
+Revises: e6a2c0f4b871
+Create Date: 2026-10-17 18:48:03.551270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1d7a3c5e902'
+down_revision = 'e6a2c0f4b871'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # В базах, созданных из database-schema.sql, остался уникальный ключ на одном collection.id:
+    # он разрешал одну книгу на подборку. Миграция 8ddf71f6c4af удаляла его только по имени
+    inspector = sa.inspect(op.get_bind())
+    for index in inspector.get_indexes('book_collection'):
+        if index['unique'] and index['column_names'] == ['collection.id']:
+            op.drop_index(index['name'], table_name='book_collection')
+    for constraint in inspector.get_unique_constraints('book_collection'):
+        if constraint['column_names'] == ['collection.id']:
+            op.drop_constraint(constraint['name'], 'book_collection', type_='unique')
+
+
+def downgrade():
+    # Уникальный ключ не восстанавливается: с ним в подборке может быть только одна книга
+    pass
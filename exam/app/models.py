@@ -1,13 +1,16 @@
 import os
+from datetime import datetime, timedelta
 
 from flask import url_for
 from flask_login import UserMixin
 import sqlalchemy as sa
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import MetaData, and_
+from sqlalchemy.orm import validates, joinedload
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app.users_policy import UsersPolicy
+from app.users_policy import ACTION_BITS, role_subject
+from app.routing import RoutingSQLAlchemy
+from app.storage import shard_key
 from app.constants import REVIEW_STATUSES, RATING_WORDS
 
 
@@ -20,12 +23,13 @@ convention = {
 }
 
 metadata = MetaData(naming_convention=convention)
-db = SQLAlchemy(metadata=metadata)
+db = RoutingSQLAlchemy(metadata=metadata)
 
 book_genre = db.Table(
         'book_genre',
-        db.Column('book.id', db.Integer, db.ForeignKey('books.id')),
-        db.Column('genre.id', db.Integer, db.ForeignKey('genres.id'))
+        db.Column('book.id', db.Integer, db.ForeignKey('books.id'), primary_key=True),
+        db.Column('genre.id', db.Integer, db.ForeignKey('genres.id'), primary_key=True),
+        db.Index('ix_book_genre_genre_id', 'genre.id', 'book.id')
     )
 
 
@@ -39,10 +43,17 @@ class Genre(db.Model):
         return '<Genre %r>' % self.name
 
 
+# Шаг между позициями книг в подборке: новая книга встает в конец без перенумерации остальных
+POSITION_STEP = 1024
+
 book_collection = db.Table(
         'book_collection',
-        db.Column('book.id', db.Integer, db.ForeignKey('books.id')),
-        db.Column('collection.id', db.Integer, db.ForeignKey('collections.id'))
+        db.Column('book.id', db.Integer, db.ForeignKey('books.id'), primary_key=True),
+        db.Column('collection.id', db.Integer, db.ForeignKey('collections.id'), primary_key=True),
+        db.Column('position', db.Integer, nullable=False, default=0, server_default='0'),
+        db.Column('added_at', db.DateTime, nullable=False, server_default=sa.sql.func.now()),
+        db.Index('ix_book_collection_collection_id', 'collection.id', 'book.id'),
+        db.Index('ix_book_collection_collection_id_position', 'collection.id', 'position', 'book.id')
     )
 
 
@@ -52,17 +63,140 @@ class Collection(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     desc = db.Column(db.Text)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    books = db.relationship('Book', secondary=book_collection, backref='collections')
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    books = db.relationship('Book', secondary=book_collection, backref='collections',
+                            order_by=(book_collection.c.position, book_collection.c['book.id']))
 
     user = db.relationship('User')
 
     def __repr__(self):
         return '<Collection %r>' % self.name
 
+    # Число книг в подборках одним GROUP BY по индексу связующей таблицы
+    @classmethod
+    def book_counts(cls, collection_ids):
+        if not collection_ids:
+            return {}
+        return dict(db.session.query(book_collection.c['collection.id'], sa.func.count(book_collection.c['book.id']))
+                    .filter(book_collection.c['collection.id'].in_(collection_ids))
+                    .group_by(book_collection.c['collection.id']))
+
+    # id подборок пользователя из списка. Строки подборок блокируются до конца транзакции,
+    # чтобы параллельные добавления не заняли одну и ту же позицию
+    @classmethod
+    def owned(cls, user_id, collection_ids):
+        if not collection_ids:
+            return []
+        return [collection_id for collection_id, in db.session.query(cls.id)
+                .filter(cls.id.in_(collection_ids), cls.user_id == user_id)
+                .order_by(cls.id)
+                .with_for_update()]
+
+    # Добавляет книги в конец подборок одним INSERT. Уже добавленные книги и несуществующие id
+    # пропускаются, поэтому повторное добавление не нарушает первичный ключ связи.
+    # Возвращает число новых связей
+    @classmethod
+    def add_books(cls, collection_ids, book_ids):
+        link = book_collection.c
+        book_ids = sorted({book_id for book_id, in db.session.query(Book.id).filter(Book.id.in_(book_ids))}) \
+            if book_ids else []
+        if not collection_ids or not book_ids:
+            return 0
+        existing = set(db.session.query(link['collection.id'], link['book.id'])
+                       .filter(link['collection.id'].in_(collection_ids), link['book.id'].in_(book_ids)))
+        last = dict(db.session.query(link['collection.id'], sa.func.max(link.position))
+                    .filter(link['collection.id'].in_(collection_ids))
+                    .group_by(link['collection.id']))
+        rows = []
+        for collection_id in collection_ids:
+            position = last.get(collection_id) or 0
+            for book_id in book_ids:
+                if (collection_id, book_id) not in existing:
+                    position += POSITION_STEP
+                    rows.append({'book.id': book_id, 'collection.id': collection_id, 'position': position})
+        if rows:
+            db.session.execute(book_collection.insert(), rows)
+            SimilarBook.mark_stale([row['book.id'] for row in rows])
+        return len(rows)
+
+    @classmethod
+    def remove_books(cls, collection_ids, book_ids):
+        if not collection_ids or not book_ids:
+            return 0
+        removed = db.session.execute(
+            book_collection.delete()
+            .where(book_collection.c['collection.id'].in_(collection_ids),
+                   book_collection.c['book.id'].in_(book_ids))
+        ).rowcount
+        if removed:
+            SimilarBook.mark_stale(book_ids)
+        return removed
+
+    # Подборки пользователя с отметкой, есть ли в них книга, одним запросом с LEFT JOIN
+    @classmethod
+    def for_book(cls, user_id, book_id, limit):
+        link = book_collection.c
+        return db.session.query(cls.id, cls.name, link['book.id'].isnot(None).label('contains')) \
+            .outerjoin(book_collection, sa.and_(link['collection.id'] == cls.id, link['book.id'] == book_id)) \
+            .filter(cls.user_id == user_id) \
+            .order_by(cls.id.desc()) \
+            .limit(limit) \
+            .all()
+
+    # В каких подборках пользователя лежит каждая из книг: {id книги: [id подборки, ...]}.
+    # Один запрос по первичному ключу связи (книга, подборка)
+    @classmethod
+    def memberships(cls, user_id, book_ids):
+        result = {}
+        if not book_ids:
+            return result
+        link = book_collection.c
+        rows = db.session.query(link['book.id'], link['collection.id']) \
+            .join(cls, cls.id == link['collection.id']) \
+            .filter(link['book.id'].in_(book_ids), cls.user_id == user_id) \
+            .order_by(link['book.id'], link['collection.id'])
+        for book_id, collection_id in rows:
+            result.setdefault(book_id, []).append(collection_id)
+        return result
+
+    # Меняет книгу местами с соседней выше (direction < 0) или ниже по порядку подборки.
+    # Затрагиваются только две строки связующей таблицы
+    @classmethod
+    def move_book(cls, collection_id, book_id, direction):
+        link = book_collection.c
+        current = db.session.query(link.position) \
+            .filter(link['collection.id'] == collection_id, link['book.id'] == book_id).scalar()
+        if current is None:
+            return False
+        key = sa.tuple_(link.position, link['book.id'])
+        if direction < 0:
+            neighbour = db.session.query(link['book.id'], link.position) \
+                .filter(link['collection.id'] == collection_id, key < sa.tuple_(current, book_id)) \
+                .order_by(link.position.desc(), link['book.id'].desc())
+        else:
+            neighbour = db.session.query(link['book.id'], link.position) \
+                .filter(link['collection.id'] == collection_id, key > sa.tuple_(current, book_id)) \
+                .order_by(link.position, link['book.id'])
+        neighbour = neighbour.first()
+        if neighbour is None:
+            return False
+        # Одинаковые позиции (например, после переноса старых данных) разводятся на шаг
+        neighbour_position = neighbour.position
+        if neighbour_position == current:
+            neighbour_position = current + (-1 if direction < 0 else 1)
+        update = book_collection.update().where(link['collection.id'] == collection_id)
+        db.session.execute(update.where(link['book.id'] == book_id).values(position=neighbour_position))
+        db.session.execute(update.where(link['book.id'] == neighbour[0]).values(position=current))
+        return True
+
 
 class Review(db.Model):
     __tablename__ = 'reviews'
+    __table_args__ = (
+        db.Index('ix_reviews_book_id_status_id_created_at', 'book_id', 'status_id', 'created_at'),
+        db.Index('ix_reviews_status_id_created_at', 'status_id', 'created_at'),
+        db.Index('ix_reviews_user_id_book_id', 'user_id', 'book_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     rating = db.Column(db.Integer, nullable=False)
@@ -77,9 +211,12 @@ class Review(db.Model):
         db.ForeignKey('review_statuses.id'),
         default=REVIEW_STATUSES['UNDER_MODERATION']['id']
     )
+    # Аренда рецензии модератором в очереди модерации
+    claimed_by = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    claimed_until = db.Column(db.DateTime)
 
     book = db.relationship('Book')
-    user = db.relationship('User')
+    user = db.relationship('User', foreign_keys=[user_id])
     status = db.relationship(
         'ReviewStatus',
         backref=db.backref('reviews', lazy=True),
@@ -89,6 +226,107 @@ class Review(db.Model):
     def rating_word(self):
         return RATING_WORDS.get(self.rating)
 
+    @property
+    def current_status(self):
+        # Статус берется из справочника в памяти, без запроса к review_statuses
+        from app import reference
+        return reference.review_status(self.status_id)
+
+    # Смена статуса условным UPDATE от прочитанного статуса: если два модератора меняют
+    # рецензию одновременно, агрегаты книги изменит только тот, чей UPDATE прошел
+    def change_status(self, status_id):
+        approved = REVIEW_STATUSES['APPROVED']['id']
+        old_status_id = self.status_id
+        if old_status_id == status_id:
+            return False
+        changed = Review.query \
+            .filter(Review.id == self.id, Review.status_id == old_status_id) \
+            .update({Review.status_id: status_id, Review.claimed_by: None, Review.claimed_until: None},
+                    synchronize_session=False)
+        db.session.expire(self, ['status_id', 'claimed_by', 'claimed_until'])
+        if not changed:
+            return False
+        if status_id == approved:
+            Book.change_approved_reviews(self.book_id, self.rating, 1)
+        elif old_status_id == approved:
+            Book.change_approved_reviews(self.book_id, self.rating, -1)
+        return True
+
+    def claimed_by_other(self, user_id):
+        return self.claimed_by not in (None, user_id) and self.claimed_until > datetime.now()
+
+    # id рецензий, которые модератор может взять на момент now: сначала уже взятые им,
+    # затем свободные и те, чья аренда истекла
+    @classmethod
+    def claimable(cls, user_id, limit, now):
+        return db.session.query(cls.id) \
+            .filter(cls.status_id == REVIEW_STATUSES['UNDER_MODERATION']['id'],
+                    sa.or_(cls.claimed_by.is_(None), cls.claimed_by == user_id, cls.claimed_until < now)) \
+            .order_by(sa.case((cls.claimed_by == user_id, 0), else_=1), cls.id) \
+            .limit(limit)
+
+    # Рецензии, арендованные модератором на момент now, вместе с книгами и авторами
+    @classmethod
+    def claimed(cls, user_id, now):
+        return cls.query \
+            .options(joinedload(cls.book), joinedload(cls.user)) \
+            .filter(cls.claimed_by == user_id,
+                    cls.claimed_until >= now,
+                    cls.status_id == REVIEW_STATUSES['UNDER_MODERATION']['id']) \
+            .order_by(cls.id)
+
+    # Выдает модератору в аренду на lease секунд до limit рецензий на рассмотрении.
+    # На MySQL строки выбираются через FOR UPDATE SKIP LOCKED, поэтому параллельные модераторы
+    # не ждут друг друга и не получают одни и те же рецензии. SQLite выполняет запись
+    # последовательно, и там достаточно одного UPDATE с подзапросом
+    @classmethod
+    def claim(cls, user_id, limit, lease):
+        now = datetime.now()
+        values = {cls.claimed_by: user_id, cls.claimed_until: now + timedelta(seconds=lease)}
+        if db.engine.dialect.name == 'mysql':
+            ids = [review_id for review_id, in cls.claimable(user_id, limit, now).with_for_update(skip_locked=True)]
+            if ids:
+                cls.query.filter(cls.id.in_(ids)).update(values, synchronize_session=False)
+        else:
+            ids = cls.claimable(user_id, limit, now).scalar_subquery()
+            cls.query.filter(cls.id.in_(ids)).update(values, synchronize_session=False)
+        db.session.commit()
+        return cls.claimed(user_id, now).all()
+
+    # Одобряет или отклоняет арендованные модератором рецензии одной транзакцией.
+    # Агрегаты книг обновляются одним executemany на все затронутые книги.
+    # Возвращает число измененных рецензий или None, если рецензии успели измениться
+    @classmethod
+    def moderate_batch(cls, review_ids, status_id, user_id):
+        pending = sa.and_(cls.id.in_(review_ids),
+                          cls.status_id == REVIEW_STATUSES['UNDER_MODERATION']['id'],
+                          cls.claimed_by == user_id)
+        rows = db.session.query(cls.id, cls.book_id, cls.rating).filter(pending).with_for_update().all()
+        if not rows:
+            return 0
+        changed = cls.query.filter(pending, cls.id.in_([row.id for row in rows])) \
+            .update({cls.status_id: status_id, cls.claimed_by: None, cls.claimed_until: None},
+                    synchronize_session=False)
+        if changed != len(rows):
+            db.session.rollback()
+            return None
+        if status_id == REVIEW_STATUSES['APPROVED']['id']:
+            totals = {}
+            for _, book_id, rating in rows:
+                count, total = totals.get(book_id, (0, 0))
+                totals[book_id] = (count + 1, total + rating)
+            books = Book.__table__
+            db.session.execute(
+                books.update()
+                .where(books.c.id == sa.bindparam('book_id'))
+                .values(approved_review_count=books.c.approved_review_count + sa.bindparam('delta_num'),
+                        rating_num=books.c.rating_num + sa.bindparam('delta_num'),
+                        rating_sum=books.c.rating_sum + sa.bindparam('delta_sum'),
+                        version=books.c.version + 1),
+                [{'book_id': book_id, 'delta_num': count, 'delta_sum': total}
+                 for book_id, (count, total) in totals.items()])
+        return changed
+
     def __repr__(self):
         return '<Review %r>' % self.text[:10]
 
@@ -102,16 +340,24 @@ class ReviewStatus(db.Model):
 
 class Book(db.Model):
     __tablename__ = 'books'
+    __table_args__ = (
+        db.Index('ix_books_name_fulltext', 'name', mysql_prefix='FULLTEXT'),
+        db.Index('ix_books_author_fulltext', 'author', mysql_prefix='FULLTEXT'),
+        db.Index('ix_books_created_at_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     short_desc = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.String(4), nullable=False)
+    year = db.Column(db.Integer, index=True)
     publishing_house = db.Column(db.String(100), nullable=False)
     author = db.Column(db.String(100), nullable=False)
     volume = db.Column(db.Integer, nullable=False)
     rating_sum = db.Column(db.Integer, nullable=False, default=0)
     rating_num = db.Column(db.Integer, nullable=False, default=0)
+    approved_review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     genres = db.relationship('Genre', secondary=book_genre, backref='books')
     background_image_id = db.Column(db.String(100), db.ForeignKey('images.id'))
 
@@ -128,19 +374,150 @@ class Book(db.Model):
     def __repr__(self):
         return '<Book %r>' % self.name
 
+    @validates('created_at')
+    def validate_created_at(self, key, value):
+        self.year = int(value) if value and str(value).isdigit() else None
+        return value
+
     @property
     def rating(self):
         if self.rating_num > 0:
             return self.rating_sum / self.rating_num
         return 0
 
-    def rating_up(self, n: int):
-        self.rating_num += 1
-        self.rating_sum += n
+    # Агрегаты одобренных рецензий меняются на стороне БД одним UPDATE, без чтения в Python
+    @classmethod
+    def change_approved_reviews(cls, book_id, rating, delta):
+        cls.query.filter_by(id=book_id).update(
+            {cls.approved_review_count: cls.approved_review_count + delta,
+             cls.rating_num: cls.rating_num + delta,
+             cls.rating_sum: cls.rating_sum + delta * rating,
+             cls.version: cls.version + 1},
+            synchronize_session=False)
+
+    @classmethod
+    def backfill_review_counts(cls, chunk_size=10000):
+        approved = sa.select(sa.func.count(Review.id)) \
+            .where(Review.book_id == cls.id,
+                   Review.status_id == REVIEW_STATUSES['APPROVED']['id']) \
+            .scalar_subquery()
+        max_id = db.session.query(sa.func.max(cls.id)).scalar() or 0
+        for start in range(0, max_id + 1, chunk_size):
+            cls.query.filter(cls.id >= start, cls.id < start + chunk_size) \
+                .update({cls.approved_review_count: approved}, synchronize_session=False)
+            db.session.commit()
+
+    # Сверяет агрегаты книг с id из [start, stop) с одобренными рецензиями.
+    # Расхождения ищутся по GROUP BY, а исправляются коррелированными подзапросами,
+    # поэтому одобрения, прошедшие между чтением и исправлением, не теряются
+    @classmethod
+    def reconcile_ratings(cls, start, stop):
+        approved = Review.status_id == REVIEW_STATUSES['APPROVED']['id']
+        actual = {
+            book_id: (num, total) for book_id, num, total in db.session.query(
+                Review.book_id, sa.func.count(Review.id), sa.func.coalesce(sa.func.sum(Review.rating), 0))
+            .filter(approved, Review.book_id >= start, Review.book_id < stop)
+            .group_by(Review.book_id)
+        }
+        drift = []
+        for book_id, num, total, count in db.session.query(
+                cls.id, cls.rating_num, cls.rating_sum, cls.approved_review_count) \
+                .filter(cls.id >= start, cls.id < stop):
+            expected_num, expected_sum = actual.get(book_id, (0, 0))
+            if (num, total, count) != (expected_num, expected_sum, expected_num):
+                drift.append((book_id, num - expected_num, total - expected_sum))
+        if drift:
+            num = sa.select(sa.func.count(Review.id)) \
+                .where(Review.book_id == cls.id, approved) \
+                .scalar_subquery()
+            total = sa.select(sa.func.coalesce(sa.func.sum(Review.rating), 0)) \
+                .where(Review.book_id == cls.id, approved) \
+                .scalar_subquery()
+            cls.query.filter(cls.id.in_([book_id for book_id, _, _ in drift])) \
+                .update({cls.rating_num: num,
+                         cls.rating_sum: total,
+                         cls.approved_review_count: num,
+                         cls.version: cls.version + 1},
+                        synchronize_session=False)
+        db.session.commit()
+        return drift
+
+
+@sa.event.listens_for(Review, 'after_delete')
+def review_deleted(mapper, connection, target):
+    if target.status_id == REVIEW_STATUSES['APPROVED']['id']:
+        books = Book.__table__
+        connection.execute(
+            books.update()
+            .where(books.c.id == target.book_id)
+            .values(approved_review_count=books.c.approved_review_count - 1,
+                    rating_num=books.c.rating_num - 1,
+                    rating_sum=books.c.rating_sum - target.rating,
+                    version=books.c.version + 1))
+
+
+# Версия книги входит в ключи кэша фрагментов и меняется при любом изменении книги.
+# Увеличивается в SQL, как при модерации и пересчете оценок: иначе правка, записанная
+# одновременно с одобрением рецензии, может вернуть книге ту же версию
+@sa.event.listens_for(Book, 'before_update')
+def book_updated(mapper, connection, target):
+    if sa.orm.object_session(target).is_modified(target):
+        target.version = Book.version + 1
+
+
+# Книги, у которых изменились подборки или жанры; их соседей пересчитывает flask similar refresh
+similar_books_stale = db.Table(
+        'similar_books_stale',
+        db.Column('book_id', db.Integer, primary_key=True),
+    )
+
+
+# Заранее посчитанные похожие книги: по rank книги идут от самой похожей.
+# Полоса на странице книги читается одним запросом по первичному ключу (book_id, rank)
+class SimilarBook(db.Model):
+    __tablename__ = 'similar_books'
+
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    similar_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return '<SimilarBook %r -> %r>' % (self.book_id, self.similar_id)
+
+    @classmethod
+    def for_book(cls, book_id, limit):
+        return db.session.query(Book.id, Book.name, Book.author, Book.background_image_id) \
+            .join(cls, cls.similar_id == Book.id) \
+            .filter(cls.book_id == book_id) \
+            .order_by(cls.rank) \
+            .limit(limit)
+
+    # Повторная отметка одной и той же книги из параллельных запросов не должна падать на ключе
+    @classmethod
+    def mark_stale(cls, book_ids):
+        if book_ids:
+            db.session.execute(
+                similar_books_stale.insert()
+                .prefix_with('IGNORE', dialect='mysql')
+                .prefix_with('OR IGNORE', dialect='sqlite'),
+                [{'book_id': book_id} for book_id in set(book_ids)])
+
+    # Перед удалением книги: ее строки убираются, а книги, у которых она была в соседях, отмечаются
+    @classmethod
+    def forget(cls, book_id):
+        neighbours = [neighbour_id for neighbour_id, in
+                      db.session.query(cls.book_id).filter(cls.similar_id == book_id)]
+        cls.query.filter(sa.or_(cls.book_id == book_id, cls.similar_id == book_id)) \
+            .delete(synchronize_session=False)
+        cls.mark_stale(neighbours)
 
 
 class Image(db.Model):
     __tablename__ = 'images'
+    __table_args__ = (
+        db.Index('ix_images_ref_count_released_at', 'ref_count', 'released_at'),
+    )
 
     id = db.Column(db.String(100), primary_key=True)
     file_name = db.Column(db.String(100), nullable=False)
@@ -149,20 +526,65 @@ class Image(db.Model):
     created_at = db.Column(db.DateTime,
                            nullable=False,
                            server_default=sa.sql.func.now())
+    # Число книг с этой обложкой. Когда оно падает до нуля, запоминается время,
+    # и после срока ожидания файлы удаляет flask images sweep
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    released_at = db.Column(db.DateTime)
 
     def __repr__(self):
         return '<Image %r>' % self.file_name
 
+    @classmethod
+    def acquire(cls, image_id):
+        cls.query.filter_by(id=image_id).update(
+            {cls.ref_count: cls.ref_count + 1, cls.released_at: None},
+            synchronize_session=False)
+
+    # released_at стоит в SET первым: MySQL подставляет в следующие выражения уже новые значения
+    @classmethod
+    def release(cls, image_id):
+        cls.query.filter_by(id=image_id).update(
+            [(cls.released_at, sa.case((cls.ref_count <= 1, datetime.now()), else_=cls.released_at)),
+             (cls.ref_count, sa.case((cls.ref_count > 0, cls.ref_count - 1), else_=0))],
+            synchronize_session=False,
+            update_args={'preserve_parameter_order': True})
+
     @property
     def storage_filename(self):
         _, ext = os.path.splitext(self.file_name)
         return self.id + ext
 
+    @property
+    def storage_key(self):
+        return shard_key(self.md5_hash, self.storage_filename)
+
     @property
     def url(self):
         return url_for('image', image_id=self.id)
 
 
+class ImageVariant(db.Model):
+    __tablename__ = 'image_variants'
+    __table_args__ = (
+        db.UniqueConstraint('image_id', 'width', 'format'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.String(100), db.ForeignKey('images.id', ondelete='CASCADE'), nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    format = db.Column(db.String(10), nullable=False)
+    mime_type = db.Column(db.String(100), nullable=False)
+    file_name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           server_default=sa.sql.func.now())
+
+    image = db.relationship('Image', backref=db.backref('variants', cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return '<ImageVariant %r>' % self.file_name
+
+
 class User(db.Model, UserMixin):
     __tablename__ = 'users'
 
@@ -187,20 +609,27 @@ class User(db.Model, UserMixin):
     def full_name(self):
         return ' '.join([self.last_name, self.first_name, self.middle_name or ''])
 
+    @property
+    def role(self):
+        # Роль берется из справочника в памяти, без ленивой загрузки self.roles
+        from app import reference
+        return reference.role(self.role_id)
+
     @property
     def is_admin(self):
-        return self.roles.name == 'Администратор'
+        return self.role is not None and role_subject(self.role.name).is_admin
 
     @property
     def is_moder(self):
-        return self.roles.name == 'Администратор' or self.roles.name == 'Модератор'
+        return self.role is not None and role_subject(self.role.name).is_moder
 
     def can(self, action, record=None):
-        users_policy = UsersPolicy(record)
-        method = getattr(users_policy, action, None)
-        if method:
-            return method()
-        return False
+        # Правила UsersPolicy заранее собраны в битовую маску для каждой роли
+        from app import reference
+        bit = ACTION_BITS.get(action)
+        if bit is None:
+            return False
+        return bool(reference.permissions(self.role_id) & bit)
 
     def __repr__(self):
         return '<User %r>' % self.login
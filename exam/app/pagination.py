@@ -0,0 +1,123 @@
+import base64
+import binascii
+import datetime
+import json
+import math
+
+from flask import request
+import sqlalchemy as sa
+
+from app.cache import LRUCache
+
+# Общее количество строк пересчитывается не чаще раза в COUNT_TTL секунд
+COUNT_TTL = 300
+counts = LRUCache(maxsize=4096, ttl=COUNT_TTL)
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return {'dt': value.isoformat(sep=' ')}
+    raise TypeError(f'Unsupported cursor value {value!r}')
+
+
+def _object_hook(value):
+    if set(value) == {'dt'}:
+        return datetime.datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(state):
+    raw = json.dumps(state, default=_default, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return json.loads(raw, object_hook=_object_hook)
+    except (ValueError, binascii.Error):
+        return None
+
+
+def _sort_key(expr):
+    # Даты сравниваются в том виде, в котором их хранит СУБД,
+    # иначе в SQLite строки с одинаковым временем теряются между страницами
+    if isinstance(expr.type, sa.DateTime):
+        return sa.type_coerce(expr, sa.String)
+    return expr
+
+
+# Постраничный вывод по ключу сортировки вместо OFFSET/LIMIT.
+# order_by - список пар (выражение, по убыванию), последним должен идти уникальный ключ.
+class KeysetPagination:
+    def __init__(self, query, order_by, per_page, cursor=None):
+        self.query = query.order_by(None)
+        # Если в запросе одна сущность, элементами страницы будут объекты, иначе кортежи колонок
+        entities = len(self.query.column_descriptions)
+        self.order_by = [(_sort_key(expr), desc) for expr, desc in order_by]
+        self.per_page = per_page
+
+        state = decode_cursor(cursor) if cursor else None
+        if not self._valid(state):
+            state = None
+        backward = state is not None and state['dir'] == 'prev'
+        self.page = max(state['page'], 1) if state else 1
+
+        rows = self.page_query(state).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backward:
+            rows.reverse()
+
+        self.items = [row[0] if entities == 1 else tuple(row[:entities]) for row in rows]
+        self.has_next = True if backward else more
+        self.has_prev = more if backward else state is not None
+        self.next_cursor = None
+        self.prev_cursor = None
+        if rows and self.has_next:
+            self.next_cursor = encode_cursor(
+                {'dir': 'next', 'keys': list(rows[-1][entities:]), 'page': self.page + 1})
+        if rows and self.has_prev:
+            self.prev_cursor = encode_cursor(
+                {'dir': 'prev', 'keys': list(rows[0][entities:]), 'page': self.page - 1})
+
+    # Запрос строк страницы после курсора state (None - первая страница) с лишней строкой,
+    # по которой видно, есть ли следующая
+    def page_query(self, state=None):
+        backward = state is not None and state['dir'] == 'prev'
+        query = self.query.add_columns(
+            *[expr.label(f'sort_key_{i}') for i, (expr, _) in enumerate(self.order_by)])
+        if state:
+            query = query.filter(self._after(state['keys'], backward))
+        query = query.order_by(
+            *[expr.desc() if desc != backward else expr.asc() for expr, desc in self.order_by])
+        return query.limit(self.per_page + 1)
+
+    def _valid(self, state):
+        return isinstance(state, dict) \
+            and state.get('dir') in ('next', 'prev') \
+            and isinstance(state.get('page'), int) \
+            and isinstance(state.get('keys'), list) \
+            and len(state['keys']) == len(self.order_by)
+
+    def _after(self, values, backward):
+        clauses = []
+        for i, ((expr, desc), value) in enumerate(zip(self.order_by, values)):
+            later = expr < value if desc != backward else expr > value
+            equal = [prev == prev_value for (prev, _), prev_value in zip(self.order_by[:i], values[:i])]
+            clauses.append(sa.and_(*equal, later))
+        return sa.or_(*clauses)
+
+    @property
+    def total(self):
+        statement = self.query.statement.compile()
+        key = (str(statement), repr(sorted(statement.params.items())))
+        return counts.get_or_set(key, self.query.count)
+
+    @property
+    def pages(self):
+        return max(math.ceil(self.total / self.per_page), self.page)
+
+
+def keyset_paginate(query, order_by, per_page):
+    return KeysetPagination(query, order_by, per_page, request.args.get('cursor'))
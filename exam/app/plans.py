@@ -0,0 +1,100 @@
+import re
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app import books, collections_books
+from app.models import db, Review, Collection, Genre, SimilarBook
+from app.pagination import KeysetPagination, decode_cursor
+
+# Строка плана SQLite без "USING INDEX" означает полный проход по таблице
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+
+
+# Первая и вторая страница постраничного запроса: на второй к запросу добавляется условие курсора
+def _pages(name, query, order_by, per_page):
+    pagination = KeysetPagination(query, order_by, per_page)
+    yield name, pagination.page_query()
+    if pagination.next_cursor:
+        yield f'{name} (стр. 2)', pagination.page_query(decode_cursor(pagination.next_cursor))
+
+
+# Запросы горячих страниц, построенные теми же функциями, что и в обработчиках.
+# Значения параметров берутся из базы, поэтому проверку стоит запускать на заполненной базе
+def hot_queries():
+    book_id = db.session.query(sa.func.min(Review.book_id)).scalar() or 1
+    user_id = db.session.query(sa.func.min(Review.user_id)).scalar() or 1
+    owner_id = db.session.query(sa.func.min(Collection.user_id)).scalar() or 1
+    genre_id = db.session.query(sa.func.min(Genre.id)).scalar() or 1
+    collection_id = db.session.query(sa.func.min(Collection.id)).filter(Collection.user_id == owner_id).scalar() or 1
+    now = datetime.now()
+    yield from _pages('books.index', *books.catalogue_query({}), books.PER_PAGE)
+    yield from _pages('books.index?genre_ids', *books.catalogue_query({'genre_ids': [genre_id]}), books.PER_PAGE)
+    yield 'books.show', books.latest_reviews_query(book_id)
+    yield 'books.show (own review)', books.own_review_query(user_id, book_id)
+    yield 'books.show (similar)', SimilarBook.for_book(book_id, books.SIMILAR_SHOWN)
+    for sort_reviews in (None, 'positive'):
+        yield from _pages(f'books.reviews?sort_reviews={sort_reviews}',
+                          *books.book_reviews_query(book_id, sort_reviews), 5)
+    yield from _pages('books.my_reviews', *books.my_reviews_query(user_id), 5)
+    yield 'books.reviews_to_moderate (claim)', \
+        Review.claimable(user_id, current_app.config['MODERATION_BATCH_SIZE'], now)
+    yield 'books.reviews_to_moderate', Review.claimed(user_id, now)
+    yield from _pages('collections.index', *collections_books.user_collections_query(owner_id), 4)
+    yield from _pages('collections.show_collection', *collections_books.collection_books_query(collection_id),
+                      collections_books.PER_PAGE)
+
+
+# EXPLAIN над запросом с обычными параметрами: подставлять их в текст литералами
+# MySQL-диалект умеет не для всех типов, например не для дат
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    prefix = 'EXPLAIN QUERY PLAN ' if compiler.dialect.name == 'sqlite' else 'EXPLAIN '
+    return prefix + compiler.process(element.statement, **kw)
+
+
+# Строки плана. Имена колонок берутся из курсора: колонки самого запроса к плану не относятся
+def explain(query):
+    result = db.session.execute(Explain(query.statement))
+    columns = [column[0] for column in result.cursor.description]
+    rows = result.cursor.fetchall()
+    result.close()
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def full_scans(query):
+    dialect = db.engine.dialect
+    if dialect.name == 'mysql':
+        return [row['table'] for row in explain(query) if row['type'] == 'ALL']
+    if dialect.name == 'sqlite':
+        rows = explain(query)
+        return [match.group(1) for match in (SQLITE_FULL_SCAN.match(row['detail']) for row in rows) if match]
+    raise click.ClickException(f'Проверка планов для {dialect.name} не поддерживается')
+
+
+@click.command('check-plans')
+@with_appcontext
+def check_plans():
+    """Проверить через EXPLAIN, что запросы горячих страниц не читают таблицы целиком."""
+    failed = False
+    for name, query in hot_queries():
+        tables = full_scans(query)
+        if tables:
+            failed = True
+            click.echo(f'{name}: полный проход по {", ".join(tables)}')
+        else:
+            click.echo(f'{name}: ok')
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+import sqlalchemy as sa
+
+from app.cache import versions
+from app.models import db, Genre, Role, ReviewStatus
+from app.users_policy import compile_permissions
+
+GenreRef = namedtuple('GenreRef', 'id name')
+RoleRef = namedtuple('RoleRef', 'id name desc')
+ReviewStatusRef = namedtuple('ReviewStatusRef', 'id name')
+
+# Справочники меняются редко: изменение через ORM увеличивает версию 'reference',
+# а остальные процессы перечитывают их не реже раза в RELOAD_TTL секунд
+RELOAD_TTL = 300
+
+
+# Неизменяемый снимок справочников жанров, ролей и статусов рецензий
+# вместе с собранными для каждой роли правами доступа
+class ReferenceData:
+    def __init__(self, genres, roles, review_statuses):
+        self.genres = tuple(genres)
+        self.roles = tuple(roles)
+        self.review_statuses = tuple(review_statuses)
+        self.genres_by_id = MappingProxyType({genre.id: genre for genre in self.genres})
+        self.genres_by_name = MappingProxyType({genre.name: genre for genre in self.genres})
+        self.roles_by_id = MappingProxyType({role.id: role for role in self.roles})
+        self.review_statuses_by_id = MappingProxyType({status.id: status for status in self.review_statuses})
+        self.permissions = MappingProxyType({role.id: compile_permissions(role.name) for role in self.roles})
+
+    @classmethod
+    def load(cls):
+        return cls(
+            genres=[GenreRef(*row) for row in db.session.query(Genre.id, Genre.name).order_by(Genre.id)],
+            roles=[RoleRef(*row) for row in db.session.query(Role.id, Role.name, Role.desc).order_by(Role.id)],
+            review_statuses=[ReviewStatusRef(*row)
+                             for row in db.session.query(ReviewStatus.id, ReviewStatus.name).order_by(ReviewStatus.id)],
+        )
+
+
+_lock = threading.Lock()
+_state = {'data': None, 'version': None, 'loaded_at': 0}
+
+
+def get():
+    state = _state
+    if state['data'] is None \
+            or state['version'] != versions.get('reference') \
+            or state['loaded_at'] + RELOAD_TTL < time.monotonic():
+        with _lock:
+            version = versions.get('reference')
+            data = ReferenceData.load()
+            state.update(data=data, version=version, loaded_at=time.monotonic())
+    return state['data']
+
+
+def genres():
+    return get().genres
+
+
+def genre(genre_id):
+    return get().genres_by_id.get(genre_id)
+
+
+def genre_by_name(name):
+    return get().genres_by_name.get(name)
+
+
+def role(role_id):
+    return get().roles_by_id.get(role_id)
+
+
+def review_status(status_id):
+    return get().review_statuses_by_id.get(status_id)
+
+
+def permissions(role_id):
+    return get().permissions.get(role_id, 0)
+
+
+def invalidate():
+    versions.bump('reference')
+
+
+@sa.event.listens_for(Genre, 'after_insert')
+@sa.event.listens_for(Genre, 'after_update')
+@sa.event.listens_for(Genre, 'after_delete')
+@sa.event.listens_for(Role, 'after_insert')
+@sa.event.listens_for(Role, 'after_update')
+@sa.event.listens_for(Role, 'after_delete')
+@sa.event.listens_for(ReviewStatus, 'after_insert')
+@sa.event.listens_for(ReviewStatus, 'after_update')
+@sa.event.listens_for(ReviewStatus, 'after_delete')
+def reference_changed(mapper, connection, target):
+    invalidate()
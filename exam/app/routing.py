@@ -0,0 +1,110 @@
+import random
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from app.cache import LRUCache
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Отдельная cookie вместо сессии Flask: чтение сессии добавило бы Vary: Cookie ко всем ответам.
+# Подделка cookie лишь заставит читать из основной базы
+PRIMARY_COOKIE = 'db_primary_until'
+
+
+# Отставание реплики в секундах; None - реплика недоступна или репликация остановлена
+def measure_lag(engine):
+    try:
+        with engine.connect() as connection:
+            if engine.dialect.name != 'mysql':
+                connection.execute(sa.text('SELECT 1'))
+                return 0
+            try:
+                row = connection.execute(sa.text('SHOW REPLICA STATUS')).mappings().first()
+            except sa.exc.ProgrammingError:
+                # MySQL до 8.0.22 и MariaDB
+                row = connection.execute(sa.text('SHOW SLAVE STATUS')).mappings().first()
+    except sa.exc.DBAPIError:
+        return None
+    if row is None:
+        return None
+    lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+    return None if lag is None else int(lag)
+
+
+# Отставание перепроверяется не чаще раза в DB_REPLICA_CHECK_INTERVAL секунд
+def replica_lag(db, app, bind_key):
+    return app.extensions['replica_lags'].get_or_set(
+        bind_key, lambda: measure_lag(db.get_engine(app, bind=bind_key)))
+
+
+# Запрос читает с реплики, если это GET без записи и пользователь недавно ничего не менял.
+# После первой записи весь остаток запроса идет в основную базу
+def _use_primary():
+    if not has_request_context() or request.method not in READ_METHODS or g.get('db_primary'):
+        return True
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+# Реплика выбирается один раз на запрос среди тех, что отстают не больше DB_REPLICA_MAX_LAG
+def _replica(db, app):
+    if 'db_replica' not in g:
+        healthy = []
+        for bind_key in app.config['DB_REPLICA_BINDS']:
+            lag = replica_lag(db, app, bind_key)
+            if lag is not None and lag <= app.config['DB_REPLICA_MAX_LAG']:
+                healthy.append(bind_key)
+        g.db_replica = db.get_engine(app, bind=random.choice(healthy)) if healthy else None
+    return g.db_replica
+
+
+def _is_write(clause):
+    return isinstance(clause, sa.sql.expression.UpdateBase) or getattr(clause, '_for_update_arg', None) is not None
+
+
+# Запись и SELECT ... FOR UPDATE всегда идут в основную базу, как и текстовые запросы
+# и соединения, запрошенные без запроса (их назначение неизвестно)
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replicas = self.app.config.get('DB_REPLICA_BINDS')
+        if not replicas or (mapper is not None and mapper.persist_selectable.info.get('bind_key')):
+            return super().get_bind(mapper, clause)
+        if self._flushing or _is_write(clause):
+            if has_request_context():
+                g.db_primary = True
+                g.db_wrote = True
+            return super().get_bind(mapper, clause)
+        if clause is not None and not isinstance(clause, sa.sql.expression.TextClause) and not _use_primary():
+            replica = _replica(self.db, self.app)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+# Flask-SQLAlchemy с сессией, распределяющей чтение по репликам из DB_REPLICA_BINDS
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# После запроса с записью пользователь DB_READ_YOUR_WRITES секунд читает из основной базы,
+# чтобы сразу видеть свои изменения, пока реплики их догоняют
+def init_replicas(app):
+    app.config.setdefault('DB_REPLICA_BINDS', [])
+    app.extensions['replica_lags'] = LRUCache(maxsize=64, ttl=app.config.get('DB_REPLICA_CHECK_INTERVAL', 10))
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote') and app.config['DB_REPLICA_BINDS']:
+            window = app.config['DB_READ_YOUR_WRITES']
+            response.set_cookie(PRIMARY_COOKIE, f'{time.time() + window:.0f}', max_age=window, httponly=True)
+        return response
@@ -0,0 +1,189 @@
+import re
+
+import sqlalchemy as sa
+
+from app.models import db, Book
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'[а-я]')
+
+# Упрощенный стеммер Портера для русского языка
+RV_RE = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+PERFECTIVE_GERUND_RE = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+REFLEXIVE_RE = re.compile(r'(с[яь])$')
+ADJECTIVE_RE = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+PARTICIPLE_RE = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+VERB_RE = re.compile(
+    r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+    r'|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$')
+NOUN_RE = re.compile(r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$')
+DERIVATIONAL_RE = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя].*ость?$')
+DERIVATIONAL_SUFFIX_RE = re.compile(r'ость?$')
+SUPERLATIVE_RE = re.compile(r'(ейше|ейш)$')
+
+# Минимальная длина основы, короче которой слово ищется целиком
+MIN_STEM_LENGTH = 3
+
+# Отдельная таблица FTS5, используется только на SQLite
+books_fts = sa.table('books_fts', sa.column('rowid'), sa.column('name'), sa.column('author'))
+
+
+def normalize(text):
+    return (text or '').lower().replace('ё', 'е')
+
+
+def stem(word):
+    if not CYRILLIC_RE.search(word):
+        return word
+    match = RV_RE.match(word)
+    if not match:
+        return word
+    start, rv = match.groups()
+    temp = PERFECTIVE_GERUND_RE.sub('', rv, 1)
+    if temp == rv:
+        rv = REFLEXIVE_RE.sub('', rv, 1)
+        temp = ADJECTIVE_RE.sub('', rv, 1)
+        if temp != rv:
+            rv = PARTICIPLE_RE.sub('', temp, 1)
+        else:
+            temp = VERB_RE.sub('', rv, 1)
+            rv = NOUN_RE.sub('', rv, 1) if temp == rv else temp
+    else:
+        rv = temp
+    rv = re.sub(r'и$', '', rv, 1)
+    if DERIVATIONAL_RE.match(rv):
+        rv = DERIVATIONAL_SUFFIX_RE.sub('', rv, 1)
+    temp = re.sub(r'ь$', '', rv, 1)
+    if temp == rv:
+        rv = SUPERLATIVE_RE.sub('', rv, 1)
+        rv = re.sub(r'нн$', 'н', rv, 1)
+    else:
+        rv = temp
+    stemmed = start + rv
+    return stemmed if len(stemmed) >= MIN_STEM_LENGTH else word
+
+
+def terms(text):
+    return [stem(word) for word in WORD_RE.findall(normalize(text))]
+
+
+# Запасной вариант для СУБД без полнотекстового индекса.
+# apply() возвращает запрос и выражение релевантности: чем оно меньше, тем выше книга в выдаче
+class LikeSearch:
+    def apply(self, query, name, author):
+        if name:
+            query = query.filter(Book.name.ilike(f'%{name}%'))
+        if author:
+            query = query.filter(Book.author.ilike(f'%{author}%'))
+        return query, None
+
+    def index(self, book):
+        pass
+
+    def index_many(self, rows):
+        pass
+
+    def remove(self, book_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+# FULLTEXT-индексы InnoDB обновляет сама СУБД
+class MySQLSearch(LikeSearch):
+    def apply(self, query, name, author):
+        rank = None
+        for column, value in ((Book.name, name), (Book.author, author)):
+            words = terms(value)
+            if not words:
+                continue
+            match = column.match(' '.join(f'+{word}*' for word in words))
+            query = query.filter(match)
+            score = sa.type_coerce(match, sa.Float)
+            rank = -score if rank is None else rank - score
+        return query, rank
+
+
+# Таблица FTS5 для локального запуска обновляется вместе с книгой
+class SQLiteSearch(LikeSearch):
+    ready = False
+
+    def apply(self, query, name, author):
+        parts = []
+        for column, value in (('name', name), ('author', author)):
+            words = terms(value)
+            if words:
+                parts.append(f'{column} : (' + ' AND '.join(f'"{word}"*' for word in words) + ')')
+        if not parts:
+            return query, None
+        self.ensure()
+        query = query \
+            .join(books_fts, books_fts.c.rowid == Book.id) \
+            .filter(sa.text('books_fts MATCH :fts_query').bindparams(fts_query=' AND '.join(parts)))
+        return query, sa.func.bm25(sa.literal_column('books_fts'))
+
+    def ensure(self):
+        if SQLiteSearch.ready:
+            return
+        db.session.execute(sa.text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts "
+            "USING fts5(name, author, tokenize='unicode61 remove_diacritics 2')"))
+        SQLiteSearch.ready = True
+
+    def index(self, book):
+        self.remove(book.id)
+        db.session.execute(books_fts.insert().values(
+            rowid=book.id, name=normalize(book.name), author=normalize(book.author)))
+
+    # Пакетная индексация новых книг из строк (id, name, author)
+    def index_many(self, rows):
+        self.ensure()
+        batch = [{'rowid': book_id, 'name': normalize(name), 'author': normalize(author)}
+                 for book_id, name, author in rows]
+        if batch:
+            db.session.execute(books_fts.insert(), batch)
+
+    def remove(self, book_id):
+        self.ensure()
+        db.session.execute(books_fts.delete().where(books_fts.c.rowid == book_id))
+
+    def rebuild(self):
+        self.ensure()
+        db.session.execute(books_fts.delete())
+        rows = db.session.query(Book.id, Book.name, Book.author).yield_per(1000)
+        batch = []
+        for book_id, name, author in rows:
+            batch.append({'rowid': book_id, 'name': normalize(name), 'author': normalize(author)})
+            if len(batch) == 1000:
+                db.session.execute(books_fts.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(books_fts.insert(), batch)
+
+
+BACKENDS = {
+    'mysql': MySQLSearch,
+    'sqlite': SQLiteSearch,
+}
+
+
+def backend():
+    return BACKENDS.get(db.engine.dialect.name, LikeSearch)()
+
+
+def index_book(book):
+    backend().index(book)
+
+
+def index_books(rows):
+    backend().index_many(rows)
+
+
+def remove_book(book_id):
+    backend().remove(book_id)
+
+
+def rebuild_index():
+    backend().rebuild()
+    db.session.commit()
@@ -0,0 +1,226 @@
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+
+from app.cache import versions
+from app.constants import GENRES, ROLES, REVIEW_STATUSES
+from app.models import db, Book, Review, User, Collection, Genre, Role, ReviewStatus, book_genre, book_collection, \
+    POSITION_STEP
+from app.search import index_books
+
+# Пользователи с известным паролем, от имени которых ходит flask bench
+BENCH_USERS = {
+    'admin': ('bench_admin', 1),
+    'moder': ('bench_moder', 2),
+    'user': ('bench_user', 3),
+}
+
+WORDS = (
+    'тень', 'город', 'море', 'ветер', 'сад', 'письмо', 'дорога', 'зима', 'остров', 'сердце',
+    'звезда', 'память', 'дом', 'река', 'огонь', 'ночь', 'время', 'мост', 'книга', 'север',
+    'тайна', 'песня', 'лес', 'гора', 'свет', 'окно', 'птица', 'война', 'мир', 'сон',
+)
+LAST_NAMES = ('Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев', 'Козлов', 'Новиков', 'Морозов', 'Волков')
+FIRST_NAMES = ('Анна', 'Иван', 'Мария', 'Петр', 'Ольга', 'Алексей', 'Елена', 'Дмитрий', 'Наталья', 'Сергей')
+PUBLISHERS = ('АСТ', 'Эксмо', 'Азбука', 'Махаон', 'Росмэн', 'Питер', 'Альпина', 'Манн, Иванов и Фербер')
+# Распределение оценок и статусов рецензий: хороших оценок и одобренных рецензий больше
+RATING_WEIGHTS = (1, 2, 3, 5, 8, 6)
+STATUS_WEIGHTS = (
+    (REVIEW_STATUSES['APPROVED']['id'], 85),
+    (REVIEW_STATUSES['UNDER_MODERATION']['id'], 10),
+    (REVIEW_STATUSES['DECLINED']['id'], 5),
+)
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _insert(table, rows, chunk_size):
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(table.insert(), rows[start:start + chunk_size])
+        db.session.commit()
+
+
+def _next_id(column):
+    return (db.session.query(sa.func.max(column)).scalar() or 0) + 1
+
+
+def ensure_reference():
+    for model, rows in ((Genre, GENRES), (Role, ROLES), (ReviewStatus, REVIEW_STATUSES.values())):
+        existing = {row_id for row_id, in db.session.query(model.id)}
+        missing = [row for row in rows if row['id'] not in existing]
+        if missing:
+            db.session.execute(model.__table__.insert(), missing)
+    db.session.commit()
+    versions.bump('reference')
+
+
+def seed_users(rng, count, password_hash, chunk_size):
+    first_id = _next_id(User.id)
+    rows = [{
+        'id': user_id,
+        'login': f'user{user_id}',
+        'password_hash': password_hash,
+        'last_name': rng.choice(LAST_NAMES),
+        'first_name': rng.choice(FIRST_NAMES),
+        'role_id': 3,
+    } for user_id in range(first_id, first_id + count)]
+    existing = {login for login, in db.session.query(User.login).filter(
+        User.login.in_([login for login, _ in BENCH_USERS.values()]))}
+    for login, role_id in BENCH_USERS.values():
+        if login not in existing:
+            rows.append({'id': first_id + len(rows), 'login': login, 'password_hash': password_hash,
+                         'last_name': 'Бенчмарк', 'first_name': login, 'role_id': role_id})
+    _insert(User.__table__, rows, chunk_size)
+    # Пользователь бенчмарка тоже пишет рецензии, чтобы его страницы были не пустыми
+    bench_user_id = db.session.query(User.id).filter(User.login == BENCH_USERS['user'][0]).scalar()
+    return [bench_user_id] + list(range(first_id, first_id + count))
+
+
+def seed_books(rng, count, chunk_size):
+    first_id = _next_id(Book.id)
+    genre_ids = [genre['id'] for genre in GENRES]
+    book_ids = list(range(first_id, first_id + count))
+    for start in range(0, count, chunk_size):
+        books, links = [], []
+        for book_id in book_ids[start:start + chunk_size]:
+            year = rng.randint(1900, 2023)
+            books.append({
+                'id': book_id,
+                'name': _words(rng, rng.randint(1, 4)).capitalize(),
+                'author': f'{rng.choice(LAST_NAMES)} {rng.choice(FIRST_NAMES)}',
+                'publishing_house': rng.choice(PUBLISHERS),
+                'volume': rng.randint(50, 1200),
+                'created_at': str(year),
+                'year': year,
+                'short_desc': f'<p>{_words(rng, rng.randint(20, 80)).capitalize()}.</p>',
+            })
+            links.extend({'book.id': book_id, 'genre.id': genre_id}
+                         for genre_id in rng.sample(genre_ids, rng.choice((1, 1, 2, 3))))
+        db.session.execute(Book.__table__.insert(), books)
+        db.session.execute(book_genre.insert(), links)
+        index_books((book['id'], book['name'], book['author']) for book in books)
+        db.session.commit()
+    return book_ids
+
+
+# Популярность книг распределена по закону Ципфа: несколько книг собирают большую часть рецензий.
+# Порядок популярности перемешан, чтобы популярные книги не шли подряд по id
+def popularity(rng, book_ids, skew):
+    ranked = list(book_ids)
+    rng.shuffle(ranked)
+    cum_weights = list(itertools.accumulate(1 / rank ** skew for rank in range(1, len(ranked) + 1)))
+    return ranked, cum_weights
+
+
+# Рецензии пишутся по пользователям: число рецензий пользователя распределено по Парето,
+# книги для него выбираются по популярности без повторов
+def seed_reviews(rng, count, user_ids, ranked, cum_weights, chunk_size):
+    first_id = _next_id(Review.id)
+    statuses, status_weights = zip(*STATUS_WEIGHTS)
+    approved = REVIEW_STATUSES['APPROVED']['id']
+    totals = {}
+    now = datetime.now()
+    average = count / len(user_ids)
+    rows = []
+    written = 0
+    for user_id in user_ids:
+        if written >= count:
+            break
+        per_user = min(count - written, len(ranked), max(1, round(average * rng.paretovariate(2) / 2)))
+        book_ids = set()
+        for _ in range(10):
+            book_ids.update(rng.choices(ranked, cum_weights=cum_weights, k=per_user - len(book_ids)))
+            if len(book_ids) == per_user:
+                break
+        for book_id in book_ids:
+            rating = rng.choices(range(6), weights=RATING_WEIGHTS)[0]
+            status_id = rng.choices(statuses, weights=status_weights)[0]
+            rows.append({
+                'id': first_id + written,
+                'rating': rating,
+                'text': _words(rng, rng.randint(10, 60)).capitalize() + '.',
+                'created_at': now - timedelta(seconds=rng.randint(0, 5 * 365 * 86400)),
+                'book_id': book_id,
+                'user_id': user_id,
+                'status_id': status_id,
+            })
+            written += 1
+            if status_id == approved:
+                num, total = totals.get(book_id, (0, 0))
+                totals[book_id] = (num + 1, total + rating)
+        if len(rows) >= chunk_size:
+            _insert(Review.__table__, rows, chunk_size)
+            rows = []
+    _insert(Review.__table__, rows, chunk_size)
+
+    books = Book.__table__
+    totals_rows = [{'book_id': book_id, 'num': num, 'total': total} for book_id, (num, total) in totals.items()]
+    for start in range(0, len(totals_rows), chunk_size):
+        db.session.execute(
+            books.update()
+            .where(books.c.id == sa.bindparam('book_id'))
+            .values(approved_review_count=books.c.approved_review_count + sa.bindparam('num'),
+                    rating_num=books.c.rating_num + sa.bindparam('num'),
+                    rating_sum=books.c.rating_sum + sa.bindparam('total'),
+                    version=books.c.version + 1),
+            totals_rows[start:start + chunk_size])
+        db.session.commit()
+    return written
+
+
+def seed_collections(rng, count, user_ids, ranked, cum_weights, chunk_size):
+    first_id = _next_id(Collection.id)
+    bench_user_id = user_ids[0]
+    collections, links = [], []
+    for collection_id in range(first_id, first_id + count):
+        # Первые подборки достаются пользователю бенчмарка, чтобы его страницы были не пустыми
+        user_id = bench_user_id if collection_id - first_id < 10 else rng.choice(user_ids)
+        collections.append({'id': collection_id, 'name': f'Подборка {collection_id}',
+                            'desc': _words(rng, 8).capitalize(), 'user_id': user_id})
+        book_ids = set(rng.choices(ranked, cum_weights=cum_weights, k=rng.randint(3, 30)))
+        links.extend({'book.id': book_id, 'collection.id': collection_id, 'position': i * POSITION_STEP}
+                     for i, book_id in enumerate(book_ids, 1))
+    _insert(Collection.__table__, collections, chunk_size)
+    _insert(book_collection, links, chunk_size)
+
+
+@click.command('seed')
+@click.option('--books', default=200000, show_default=True)
+@click.option('--reviews', default=2000000, show_default=True)
+@click.option('--users', default=50000, show_default=True)
+@click.option('--collections', default=20000, show_default=True)
+@click.option('--skew', default=1.1, show_default=True, help='Показатель распределения Ципфа для популярности книг.')
+@click.option('--password', default='bench', show_default=True, help='Пароль всех созданных пользователей.')
+@click.option('--seed', 'random_seed', default=42, show_default=True)
+@click.option('--chunk-size', default=10000, show_default=True)
+@with_appcontext
+def seed(books, reviews, users, collections, skew, password, random_seed, chunk_size):
+    """Заполнить базу синтетическими данными для нагрузочных замеров.
+
+    Данные добавляются к уже существующим. Создаются и пользователи bench_admin, bench_moder
+    и bench_user, от имени которых flask bench открывает закрытые страницы.
+    """
+    rng = random.Random(random_seed)
+    started = time.monotonic()
+    ensure_reference()
+    # Хэш пароля считается один раз: на каждом пользователе это заняло бы часы
+    user_ids = seed_users(rng, users, generate_password_hash(password), chunk_size)
+    click.echo(f'Пользователи: {users}')
+    book_ids = seed_books(rng, books, chunk_size)
+    click.echo(f'Книги: {len(book_ids)}')
+    ranked, cum_weights = popularity(rng, book_ids, skew)
+    written = seed_reviews(rng, reviews, user_ids, ranked, cum_weights, chunk_size) if user_ids and book_ids else 0
+    click.echo(f'Рецензии: {written}')
+    if user_ids and book_ids:
+        seed_collections(rng, collections, user_ids, ranked, cum_weights, chunk_size)
+        click.echo(f'Подборки: {collections}')
+    versions.bump('books')
+    click.echo(f'Готово за {time.monotonic() - started:.0f} с')
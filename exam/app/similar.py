@@ -0,0 +1,193 @@
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+import sqlalchemy as sa
+
+from app.models import db, Book, SimilarBook, book_collection, book_genre, similar_books_stale
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = sparse = None
+
+# Вклад сигналов в оценку похожести: косинус по общим подборкам, косинус по жанрам
+# и априорная оценка книги по одобренным рецензиям (среднее, сглаженное к общему среднему)
+COLLECTION_WEIGHT = 1.0
+GENRE_WEIGHT = 0.3
+RATING_WEIGHT = 0.1
+PRIOR_REVIEWS = 5
+# Сколько книг обрабатывается одним умножением разреженных матриц и одной транзакцией
+CHUNK_SIZE = 2000
+FETCH_SIZE = 50000
+
+similar_cli = AppGroup('similar', help='Похожие книги для страницы книги.')
+
+
+def _fetch(*columns):
+    result = db.session.execute(sa.select(*columns).execution_options(yield_per=FETCH_SIZE))
+    parts = [np.array(partition, dtype=np.int64) for partition in result.partitions()]
+    return np.concatenate(parts) if parts else np.empty((0, len(columns)), dtype=np.int64)
+
+
+def _normalize(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+
+# Сигналы всех книг в памяти: строка матрицы - книга в порядке id
+class Signals:
+    def __init__(self):
+        books = _fetch(Book.id, Book.rating_num, Book.rating_sum)
+        self.ids = books[:, 0]
+        count = len(self.ids)
+        num, total = books[:, 1].astype(np.float64), books[:, 2].astype(np.float64)
+        mean = total.sum() / num.sum() if num.sum() else 0
+        self.prior = ((total + PRIOR_REVIEWS * mean) / (num + PRIOR_REVIEWS) / 5).astype(np.float32)
+
+        self.collections = self._matrix(_fetch(book_collection.c['book.id'], book_collection.c['collection.id']), count)
+        self.collections_t = self.collections.T.tocsr()
+        self.genres = self._matrix(_fetch(book_genre.c['book.id'], book_genre.c['genre.id']), count).toarray()
+
+        # Для книг без общих подборок: лучшие по оценке книги каждого жанра
+        self.genre_top = []
+        for genre in range(self.genres.shape[1]):
+            members = np.flatnonzero(self.genres[:, genre])
+            self.genre_top.append(members[np.argsort(-self.prior[members], kind='stable')[:self.k * 2]])
+
+    @property
+    def k(self):
+        return current_app.config['SIMILAR_BOOKS_K']
+
+    # Позиции книг с данными id; -1 для книг, которых уже нет
+    def rows(self, book_ids):
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, book_ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == book_ids[found]
+        return np.where(found, positions, -1)
+
+    def _matrix(self, pairs, count):
+        rows = self.rows(pairs[:, 0])
+        pairs, rows = pairs[rows >= 0], rows[rows >= 0]
+        columns = np.unique(pairs[:, 1], return_inverse=True)[1].ravel()
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                                   shape=(count, int(columns.max()) + 1 if len(columns) else 0))
+        return _normalize(matrix)
+
+    # Книги, у которых есть общие подборки с данными
+    def co_collected(self, rows):
+        if not len(rows):
+            return rows
+        return np.unique(self.collections[rows].dot(self.collections_t).indices)
+
+    # Соседи строк rows: кандидаты - книги из общих подборок и, если их меньше k, лучшие книги тех же жанров
+    def neighbours(self, rows):
+        k = self.k
+        overlap = self.collections[rows].dot(self.collections_t).tocsr()
+        for i, row in enumerate(rows):
+            start, end = overlap.indptr[i], overlap.indptr[i + 1]
+            candidates, shared = overlap.indices[start:end], overlap.data[start:end]
+            keep = candidates != row
+            candidates, shared = candidates[keep], shared[keep]
+            if len(candidates) < k:
+                genres = np.flatnonzero(self.genres[row])
+                if len(genres):
+                    extra = np.setdiff1d(np.concatenate([self.genre_top[genre] for genre in genres]),
+                                         np.append(candidates, row))
+                    candidates = np.concatenate([candidates, extra])
+                    shared = np.concatenate([shared, np.zeros(len(extra), dtype=shared.dtype)])
+            if not len(candidates):
+                yield int(self.ids[row]), [], []
+                continue
+            scores = COLLECTION_WEIGHT * shared \
+                + GENRE_WEIGHT * self.genres[candidates].dot(self.genres[row]) \
+                + RATING_WEIGHT * self.prior[candidates]
+            if len(candidates) > k:
+                top = np.argpartition(-scores, k)[:k]
+                candidates, scores = candidates[top], scores[top]
+            order = np.lexsort((self.ids[candidates], -scores))
+            yield int(self.ids[row]), self.ids[candidates[order]].tolist(), scores[order].tolist()
+
+
+# Заменяет соседей книг одной транзакцией на пачку: страница книги видит либо старый, либо новый список
+def store(results):
+    book_ids = [book_id for book_id, _, _ in results]
+    rows = [{'book_id': book_id, 'rank': rank, 'similar_id': similar_id, 'score': score}
+            for book_id, similar_ids, scores in results
+            for rank, (similar_id, score) in enumerate(zip(similar_ids, scores), 1)]
+    SimilarBook.query.filter(SimilarBook.book_id.in_(book_ids)).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(SimilarBook.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def compute(signals, rows):
+    stored = 0
+    for start in range(0, len(rows), CHUNK_SIZE):
+        stored += store(list(signals.neighbours(rows[start:start + CHUNK_SIZE])))
+    return stored
+
+
+# Отметки снимаются до расчета: изменения, случившиеся во время расчета, дождутся следующего запуска.
+# Если расчет упадет, отметки возвращаются
+def take_stale():
+    stale = [book_id for book_id, in db.session.query(similar_books_stale.c.book_id)]
+    if stale:
+        db.session.execute(similar_books_stale.delete().where(similar_books_stale.c.book_id.in_(stale)))
+    db.session.commit()
+    return stale
+
+
+def _run(stale, build):
+    started = time.monotonic()
+    try:
+        signals = Signals()
+        rows = build(signals)
+        stored = compute(signals, rows)
+    except BaseException:
+        db.session.rollback()
+        SimilarBook.mark_stale(stale)
+        db.session.commit()
+        raise
+    click.echo(f'Пересчитано книг: {len(rows)}, строк соседей: {stored}, '
+               f'за {time.monotonic() - started:.1f} с')
+
+
+def _require_numpy():
+    if np is None:
+        raise click.ClickException('Для расчета похожих книг нужны пакеты numpy и scipy')
+
+
+@similar_cli.command('rebuild')
+def rebuild():
+    """Пересчитать похожие книги для всего каталога."""
+    _require_numpy()
+    _run(take_stale(), lambda signals: np.arange(len(signals.ids)))
+
+
+@similar_cli.command('refresh')
+def refresh():
+    """Пересчитать похожие книги для книг, у которых изменились подборки или жанры.
+
+    Вместе с ними пересчитываются книги из общих с ними подборок и книги, у которых
+    они были в соседях. Соседи по одним только жанрам и оценкам обновляет flask similar rebuild.
+    """
+    _require_numpy()
+    stale = take_stale()
+    if not stale:
+        click.echo('Нет изменившихся книг')
+        return
+    listed = [book_id for book_id, in db.session.query(SimilarBook.book_id)
+              .filter(SimilarBook.similar_id.in_(stale)).distinct()]
+
+    def affected(signals):
+        rows = signals.rows(stale + listed)
+        rows = np.unique(rows[rows >= 0])
+        return np.union1d(rows, signals.co_collected(rows))
+
+    _run(stale, affected)
@@ -0,0 +1,118 @@
+import re
+import threading
+import time
+import traceback
+from collections import Counter, deque, namedtuple
+
+from flask import Blueprint, g, has_request_context, request, render_template, current_app
+from flask_login import login_required
+import sqlalchemy as sa
+
+from app.auth import permission_check
+
+bp = Blueprint('sqlstats', __name__, url_prefix='/debug')
+
+# Списки параметров IN (?, ?, ?) разной длины и литералы сводятся к одному отпечатку
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+NUMBER = re.compile(r'\b\d+\b')
+STRING = re.compile(r"'(?:[^']|'')*'")
+SPACES = re.compile(r'\s+')
+
+RequestReport = namedtuple('RequestReport', 'method path status count duration repeated')
+Repeated = namedtuple('Repeated', 'fingerprint count duration location')
+
+# Последние запросы для страницы /debug/sql
+_history = deque()
+_history_lock = threading.Lock()
+
+
+def fingerprint(statement):
+    statement = IN_LIST.sub('(?...)', statement)
+    statement = STRING.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    return SPACES.sub(' ', statement).strip()
+
+
+# Статистика SQL одного HTTP-запроса
+class RequestStats:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.count = 0
+        self.duration = 0.0
+        self.counts = Counter()
+        self.durations = Counter()
+        self.locations = {}
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        key = fingerprint(statement)
+        self.counts[key] += 1
+        self.durations[key] += duration
+        # Место в коде запоминается один раз, когда запрос впервые достиг порога
+        if self.counts[key] == self.threshold:
+            self.locations[key] = _app_frame()
+
+    def repeated(self):
+        return [Repeated(key, count, self.durations[key], self.locations.get(key))
+                for key, count in self.counts.most_common() if count >= self.threshold]
+
+
+def _app_frame():
+    for frame in reversed(traceback.extract_stack()[:-3]):
+        if '/app/' in frame.filename and not frame.filename.endswith('sqlstats.py'):
+            return f'{frame.filename.rsplit("/app/", 1)[-1]}:{frame.lineno} {frame.name}'
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.sqlstats_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        stats = g.get('sql_stats')
+        if stats is not None:
+            stats.record(statement, time.perf_counter() - context.sqlstats_started)
+
+
+def _start_request():
+    g.sql_stats = RequestStats(current_app.config['SQL_STATS_REPEAT_THRESHOLD'])
+
+
+def _finish_request(response):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return response
+    response.headers.add('Server-Timing', f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} SQL"')
+    repeated = stats.repeated()
+    for item in repeated:
+        current_app.logger.warning('Возможный N+1 в %s %s: %d раз (%s) %s',
+                                   request.method, request.path, item.count, item.location, item.fingerprint)
+    report = RequestReport(request.method, request.full_path.rstrip('?'), response.status_code,
+                           stats.count, stats.duration, repeated)
+    with _history_lock:
+        _history.appendleft(report)
+        while len(_history) > current_app.config['SQL_STATS_HISTORY']:
+            _history.pop()
+    return response
+
+
+# Без SQL_STATS обработчики событий не регистрируются и накладных расходов нет
+def init_sql_stats(app):
+    if not app.config.get('SQL_STATS'):
+        return
+    sa.event.listen(sa.engine.Engine, 'before_cursor_execute', _before_cursor_execute)
+    sa.event.listen(sa.engine.Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.register_blueprint(bp)
+
+
+@bp.route('/sql')
+@login_required
+@permission_check('sql_stats')
+def sql_stats():
+    with _history_lock:
+        reports = list(_history)
+    return render_template('debug/sql.html', reports=reports)
@@ -0,0 +1,266 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app, send_file, Response
+from flask.cli import AppGroup
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import NotFound
+
+CHUNK_SIZE = 64 * 1024
+
+
+# Файлы раскладываются по каталогам из первых символов md5 содержимого: ab/cd/<uuid>.jpg,
+# чтобы ни в одном каталоге не накапливались сотни тысяч файлов
+def shard_key(md5_hash, name):
+    return f'{md5_hash[:2]}/{md5_hash[2:4]}/{name}'
+
+
+# Хранилище в локальной файловой системе. Файлы, загруженные до разбиения на каталоги,
+# лежат прямо в корне и находятся по имени, пока migrate-storage их не перенесет
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+        self.spool_dir = root
+
+    def sharded_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def legacy_path(self, key):
+        return os.path.join(self.root, key.rsplit('/', 1)[-1])
+
+    def local_path(self, key):
+        path = self.sharded_path(key)
+        if os.path.isfile(path):
+            return path
+        legacy = self.legacy_path(key)
+        if os.path.isfile(legacy):
+            return legacy
+        return None
+
+    def exists(self, key):
+        return self.local_path(key) is not None
+
+    # Переносит готовый файл под ключ; src_path должен быть на той же файловой системе
+    def put_file(self, src_path, key, mime_type=None):
+        path = self.sharded_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+
+    def copy_file(self, src_path, key, mime_type=None):
+        path = self.sharded_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def download(self, key, dest_path):
+        path = self.local_path(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        shutil.copyfile(path, dest_path)
+
+    def delete(self, key):
+        for path in (self.sharded_path(key), self.legacy_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # Ключи и время изменения файлов каталога первого уровня shard ('ab'),
+    # а при shard=None - файлов в корне, загруженных до разбиения на каталоги.
+    # Служебные файлы (временные, с точкой в начале) пропускаются
+    def iter_files(self, shard):
+        if shard is None:
+            yield from self._scan(self.root, '')
+            return
+        try:
+            with os.scandir(os.path.join(self.root, shard)) as entries:
+                subdirs = sorted(entry.name for entry in entries if entry.is_dir())
+        except FileNotFoundError:
+            return
+        for subdir in subdirs:
+            yield from self._scan(os.path.join(self.root, shard, subdir), f'{shard}/{subdir}/')
+
+    def _scan(self, path, prefix):
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.') or entry.name.endswith('.tmp') or not entry.is_file():
+                        continue
+                    yield prefix + entry.name, entry.stat().st_mtime
+        except FileNotFoundError:
+            return
+
+    # Переносит файл из корня в его каталог. Сначала создается жесткая ссылка, а потом удаляется
+    # старое имя, поэтому в любой момент файл доступен хотя бы по одному из путей
+    def reshard(self, key):
+        legacy = self.legacy_path(key)
+        if not os.path.isfile(legacy):
+            return 'skipped' if os.path.isfile(self.sharded_path(key)) else 'missing'
+        path = self.sharded_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(legacy, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            self.copy_file(legacy, key)
+        os.remove(legacy)
+        return 'moved'
+
+    def send(self, key, mime_type, etag, max_age):
+        path = self.local_path(key)
+        if path is None:
+            raise NotFound()
+        return send_file(path, mimetype=mime_type, etag=etag, conditional=True, max_age=max_age)
+
+
+# S3-совместимое хранилище (AWS, MinIO, локальный moto_server через endpoint_url)
+class S3Storage:
+    def __init__(self, bucket, prefix='', endpoint_url=None):
+        import boto3
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.spool_dir = None
+
+    def object_key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def copy_file(self, src_path, key, mime_type=None):
+        extra = {'ContentType': mime_type} if mime_type else None
+        self.client.upload_file(src_path, self.bucket, self.object_key(key), ExtraArgs=extra)
+
+    def put_file(self, src_path, key, mime_type=None):
+        self.copy_file(src_path, key, mime_type)
+        os.remove(src_path)
+
+    def download(self, key, dest_path):
+        self.client.download_file(self.bucket, self.object_key(key), dest_path)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def iter_files(self, shard):
+        params = {'Bucket': self.bucket, 'Prefix': self.prefix + (f'{shard}/' if shard else '')}
+        if shard is None:
+            params['Delimiter'] = '/'
+        for page in self.client.get_paginator('list_objects_v2').paginate(**params):
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):], obj['LastModified'].timestamp()
+
+    def send(self, key, mime_type, etag, max_age):
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.client.exceptions.NoSuchKey:
+            raise NotFound()
+        response = Response(obj['Body'].iter_chunks(CHUNK_SIZE), mimetype=mime_type, direct_passthrough=True)
+        response.content_length = obj['ContentLength']
+        response.set_etag(etag)
+        response.cache_control.max_age = max_age
+        return response
+
+
+def init_storage(app):
+    if app.config.get('IMAGE_STORAGE', 'local') == 's3':
+        backend = S3Storage(app.config['IMAGE_STORAGE_S3_BUCKET'],
+                            prefix=app.config.get('IMAGE_STORAGE_S3_PREFIX', ''),
+                            endpoint_url=app.config.get('IMAGE_STORAGE_S3_ENDPOINT'))
+    else:
+        backend = LocalStorage(app.config['UPLOAD_FOLDER'])
+    app.extensions['image_storage'] = backend
+
+
+def storage():
+    return current_app.extensions['image_storage']
+
+
+# Временный каталог рядом с хранилищем, чтобы перенос готового файла был переименованием
+def make_spool_dir(prefix):
+    return tempfile.mkdtemp(prefix=prefix, dir=storage().spool_dir)
+
+
+images_cli = AppGroup('images', help='Обслуживание загруженных изображений.')
+
+
+@images_cli.command('migrate-storage')
+@click.option('--workers', default=8, show_default=True)
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--delete-source', is_flag=True, help='Удалять локальные файлы после копирования в S3.')
+def migrate_storage(workers, batch_size, delete_source):
+    """Перенести файлы из UPLOAD_FOLDER в текущее хранилище по каталогам md5.
+
+    Приложение при этом продолжает работать: локальное хранилище находит еще не перенесенные
+    файлы по старому пути. При переходе на S3 команду стоит запустить до переключения
+    IMAGE_STORAGE и еще раз после него, чтобы докопировать загруженное в промежутке.
+    """
+    from app.models import db, Image
+
+    source = LocalStorage(current_app.config['UPLOAD_FOLDER'])
+    target = storage()
+
+    def move(key):
+        if isinstance(target, LocalStorage) and target.root == source.root:
+            return source.reshard(key)
+        if target.exists(key):
+            return 'skipped'
+        path = source.local_path(key)
+        if path is None:
+            return 'missing'
+        target.copy_file(path, key, mimetypes.guess_type(path)[0])
+        if delete_source:
+            os.remove(path)
+        return 'moved'
+
+    def keys():
+        last_id = ''
+        while True:
+            images = Image.query.options(selectinload(Image.variants)) \
+                .filter(Image.id > last_id) \
+                .order_by(Image.id) \
+                .limit(batch_size) \
+                .all()
+            if not images:
+                break
+            last_id = images[-1].id
+            for img in images:
+                yield img.storage_key
+                for variant in img.variants:
+                    yield shard_key(img.md5_hash, variant.file_name)
+            db.session.expunge_all()
+
+    stats = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for key in keys():
+            batch.append(key)
+            if len(batch) >= batch_size:
+                _report(stats, batch, pool.map(move, batch))
+                batch = []
+        _report(stats, batch, pool.map(move, batch))
+
+
+def _report(stats, keys, results):
+    for key, result in zip(keys, results):
+        stats[result] += 1
+        if result == 'missing':
+            click.echo(f'Нет файла: {key}', err=True)
+    click.echo(f'Перенесено: {stats["moved"]}, уже на месте: {stats["skipped"]}, не найдено: {stats["missing"]}')
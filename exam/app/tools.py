@@ -1,11 +1,16 @@
 import hashlib
 import uuid
 import os
+import tempfile
+from collections import namedtuple
 
 from werkzeug.utils import secure_filename
 
 from app import app
 from app.models import db, Book, Image, Genre
+from app import search
+from app.cache import LRUCache
+from app.storage import storage
 
 
 from sqlalchemy.orm import joinedload
@@ -13,12 +18,12 @@ from sqlalchemy.orm import joinedload
 from sqlalchemy import func
 
 class BooksFilter:
-    def __init__(self, name='', author='', genre_ids=None, volume_from='', volume_to='', created_at=None):
+    def __init__(self, name='', author='', genre_ids=None, volume_from='', volume_to='', created_at=None,
+                 year_from=None, year_to=None):
         self.query = Book.query
-        if name:
-            self.query = self.query.filter(Book.name.ilike(f'%{name}%'))
-        if author:
-            self.query = self.query.filter(Book.author.ilike(f'%{author}%'))
+        self.rank = None
+        if name or author:
+            self.query, self.rank = search.backend().apply(self.query, name, author)
         if genre_ids:
             self.query = self.query.filter(Book.genres.any(Genre.id.in_(genre_ids)))
         if volume_from:
@@ -26,21 +31,83 @@ class BooksFilter:
         if volume_to:
             self.query = self.query.filter(Book.volume <= volume_to)
         if created_at:
-            self.query = self.query.filter(Book.created_at.in_(created_at))
+            self.query = self.query.filter(Book.year.in_(created_at))
+        if year_from:
+            self.query = self.query.filter(Book.year >= year_from)
+        if year_to:
+            self.query = self.query.filter(Book.year <= year_to)
+
+    def sort_keys(self):
+        keys = [(Book.created_at, True), (Book.id, True)]
+        if self.rank is not None:
+            keys.insert(0, (self.rank, False))
+        return keys
 
     def perform(self):
-        return self.query.order_by(Book.created_at.desc())
+        return self.query.order_by(
+            *[expr.desc() if desc else expr.asc() for expr, desc in self.sort_keys()])
 
  
 
 
+# Параметры BooksFilter из строки запроса
+def books_filter_params(args):
+    return {
+        'name': args.get('name', ''),
+        'author': args.get('author', ''),
+        'genre_ids': args.getlist('genre_ids', type=int),
+        'volume_from': args.get('volume_from', ''),
+        'volume_to': args.get('volume_to', ''),
+        'created_at': args.getlist('created_at', type=int),  # Параметр для выбранных годов издания
+        'year_from': args.get('year_from', type=int),
+        'year_to': args.get('year_to', type=int),
+    }
+
+
+ImageInfo = namedtuple('ImageInfo', 'storage_key mime_type md5_hash')
+
+# Изображения не меняются после загрузки, поэтому id -> файл можно держать в памяти процесса
+image_infos = LRUCache(maxsize=65536)
+
+
+def image_info(image_id):
+    info = image_infos.get(image_id)
+    if info is None:
+        img = Image.query.get(image_id)
+        if img is None:
+            return None
+        info = ImageInfo(img.storage_key, img.mime_type, img.md5_hash)
+        image_infos.set(image_id, info)
+    return info
+
+
+def forget_image(image_id):
+    image_infos.delete(image_id)
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+# Загрузка обложки за один проход: файл читается блоками, md5 считается по ходу записи
+# во временный файл, а в хранилище он переносится только вместе с фиксацией транзакции
 class ImageSaver:
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, file):
         self.file = file
+        self.img = None
+        self.tmp_path = None
 
     def save(self):
-        self.img = self.__find_by_md5_hash()
+        limit = app.app.config['MAX_IMAGE_SIZE']
+        if self.file.content_length and self.file.content_length > limit:
+            raise ImageTooLarge()
+        self.__spool(limit)
+        # Блокировка строки не дает flask images sweep удалить изображение, которое сейчас снова используется
+        self.img = Image.query.filter(Image.md5_hash == self.md5_hash).with_for_update().first()
         if self.img is not None:
+            self.discard()
             return self.img
         file_name = secure_filename(self.file.filename)
         self.img = Image(
@@ -48,14 +115,42 @@ class ImageSaver:
             file_name=file_name,
             mime_type=self.file.mimetype,
             md5_hash=self.md5_hash)
-        self.file.save(
-            os.path.join(app.app.config['UPLOAD_FOLDER'],
-                         self.img.storage_filename))
         db.session.add(self.img)
-        db.session.commit()
         return self.img
 
-    def __find_by_md5_hash(self):
-        self.md5_hash = hashlib.md5(self.file.read()).hexdigest()
-        self.file.seek(0)
-        return Image.query.filter(Image.md5_hash == self.md5_hash).first()
+    # Переносит файл в хранилище и фиксирует транзакцию; если фиксация не удалась, файл удаляется
+    def commit(self):
+        stored = self.tmp_path is not None
+        if stored:
+            storage().put_file(self.tmp_path, self.img.storage_key, self.img.mime_type)
+            self.tmp_path = None
+        try:
+            db.session.commit()
+        except BaseException:
+            if stored:
+                storage().delete(self.img.storage_key)
+            raise
+
+    # Удаляет временный файл, если загрузка не понадобилась или транзакция откатывается
+    def discard(self):
+        if self.tmp_path is not None:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            self.tmp_path = None
+
+    def __spool(self, limit):
+        md5 = hashlib.md5()
+        size = 0
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.upload-', dir=storage().spool_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: self.file.stream.read(self.CHUNK_SIZE), b''):
+                    size += len(chunk)
+                    if size > limit:
+                        raise ImageTooLarge()
+                    md5.update(chunk)
+                    out.write(chunk)
+        except BaseException:
+            self.discard()
+            raise
+        self.md5_hash = md5.hexdigest()
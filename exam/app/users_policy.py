@@ -1,28 +1,65 @@
-from flask_login import current_user
+from collections import namedtuple
+
+from app.constants import ROLES
+
+ADMIN_ROLE_NAME = ROLES[0]['name']
+MODER_ROLE_NAME = ROLES[1]['name']
+
+# Все правила зависят только от роли, поэтому проверяются на объекте-заглушке роли
+RoleSubject = namedtuple('RoleSubject', 'is_admin is_moder')
 
 
 class UsersPolicy:
-    def __init__(self, record):
+    def __init__(self, user, record=None):
+        self.user = user
         self.record = record
 
     def create(self):
-        return current_user.is_admin
+        return self.user.is_admin
 
     def delete(self):
-        return current_user.is_admin
+        return self.user.is_admin
 
     def show(self):
         return True
     
     def update(self):
-        return current_user.is_moder
+        return self.user.is_moder
     
     def show_collections(self):
-        if not current_user.is_moder and not current_user.is_admin:
+        if not self.user.is_moder and not self.user.is_admin:
             return True
 
     def reviews_to_moderate(self):
-        return current_user.is_moder
+        return self.user.is_moder
 
     def review(self):
-        return current_user.is_moder
+        return self.user.is_moder
+
+    def export(self):
+        return self.user.is_admin
+
+    def sql_stats(self):
+        return self.user.is_admin
+
+
+ACTIONS = tuple(name for name, value in vars(UsersPolicy).items()
+                if callable(value) and not name.startswith('_'))
+ACTION_BITS = {action: 1 << i for i, action in enumerate(ACTIONS)}
+
+
+def role_subject(role_name):
+    return RoleSubject(
+        is_admin=role_name == ADMIN_ROLE_NAME,
+        is_moder=role_name in (ADMIN_ROLE_NAME, MODER_ROLE_NAME),
+    )
+
+
+# Битовая маска разрешенных действий для роли
+def compile_permissions(role_name):
+    policy = UsersPolicy(role_subject(role_name))
+    mask = 0
+    for action, bit in ACTION_BITS.items():
+        if getattr(policy, action)():
+            mask |= bit
+    return mask
@@ -0,0 +1,191 @@
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+from flask import current_app
+import sqlalchemy as sa
+
+from app.cache import LRUCache
+from app.models import db, Image, ImageVariant
+from app.storage import images_cli, storage, shard_key, make_spool_dir
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+# Формат производного изображения: (формат Pillow, расширение, MIME-тип)
+FORMATS = {
+    'webp': ('WEBP', '.webp', 'image/webp'),
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+}
+
+VariantInfo = namedtuple('VariantInfo', 'width format mime_type file_name')
+
+# Готовые наборы вариантов не меняются, пока изображение существует
+variant_infos = LRUCache(maxsize=65536)
+
+_executor = None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=current_app.config['IMAGE_VARIANT_WORKERS'])
+    return _executor
+
+
+# Выполняется в отдельном процессе: уменьшает оригинал до каждой ширины и сохраняет во всех форматах
+def render_variants(source_path, target_dir, image_id, widths, formats):
+    results = []
+    with PILImage.open(source_path) as original:
+        original.load()
+        for width in widths:
+            resized = original.copy()
+            if resized.width > width:
+                resized = resized.resize((width, max(1, round(resized.height * width / resized.width))))
+            for fmt in formats:
+                pil_format, ext, mime_type = FORMATS[fmt]
+                frame = resized.convert('RGB') if pil_format == 'JPEG' else resized
+                file_name = f'{image_id}-{width}{ext}'
+                frame.save(os.path.join(target_dir, file_name), pil_format, quality=80)
+                results.append({
+                    'image_id': image_id,
+                    'width': width,
+                    'format': fmt,
+                    'mime_type': mime_type,
+                    'file_name': file_name,
+                })
+    return results
+
+
+# Варианты строятся во временном каталоге; если хранилище не локальное, туда же скачивается оригинал
+def _submit(img):
+    config = current_app.config
+    workdir = make_spool_dir('.variants-')
+    source = storage().local_path(img.storage_key)
+    if source is None:
+        source = os.path.join(workdir, img.storage_filename)
+        storage().download(img.storage_key, source)
+    future = executor().submit(
+        render_variants,
+        source,
+        workdir,
+        img.id,
+        config['IMAGE_VARIANT_WIDTHS'],
+        config['IMAGE_VARIANT_FORMATS'])
+    return future, workdir
+
+
+def _store(md5_hash, workdir, rows):
+    if not rows:
+        return
+    for row in rows:
+        storage().put_file(os.path.join(workdir, row['file_name']),
+                           shard_key(md5_hash, row['file_name']), row['mime_type'])
+    existing = {
+        (width, fmt) for width, fmt in db.session.query(ImageVariant.width, ImageVariant.format)
+        .filter(ImageVariant.image_id == rows[0]['image_id'])
+    }
+    rows = [row for row in rows if (row['width'], row['format']) not in existing]
+    if rows:
+        db.session.execute(sa.insert(ImageVariant.__table__), rows)
+    db.session.commit()
+
+
+# Ставит построение вариантов в очередь пула процессов, запрос их не ждет
+def schedule_variants(img):
+    if PILImage is None:
+        return
+    app = current_app._get_current_object()
+    image_id, md5_hash = img.id, img.md5_hash
+    future, workdir = _submit(img)
+
+    def done(future):
+        if future.exception() is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+            app.logger.warning('Не удалось построить варианты изображения %s: %s', image_id, future.exception())
+            return
+        with app.app_context():
+            try:
+                _store(md5_hash, workdir, future.result())
+            except (sa.exc.SQLAlchemyError, OSError):
+                db.session.rollback()
+                app.logger.exception('Не удалось сохранить варианты изображения %s', image_id)
+            finally:
+                db.session.remove()
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    future.add_done_callback(done)
+
+
+def variants_for(image_id):
+    variants = variant_infos.get(image_id)
+    if variants is None:
+        variants = tuple(
+            VariantInfo(*row) for row in db.session.query(
+                ImageVariant.width, ImageVariant.format, ImageVariant.mime_type, ImageVariant.file_name)
+            .filter(ImageVariant.image_id == image_id)
+            .order_by(ImageVariant.width)
+        )
+        config = current_app.config
+        # Пока варианты строятся, набор не кэшируется, чтобы не закрепить неполный список
+        if len(variants) == len(config['IMAGE_VARIANT_WIDTHS']) * len(config['IMAGE_VARIANT_FORMATS']):
+            variant_infos.set(image_id, variants)
+    return variants
+
+
+# Наименьший вариант не уже запрошенной ширины в подходящем формате, None - отдавать оригинал
+def pick_variant(image_id, width, accept_webp):
+    fmt = 'webp' if accept_webp else 'jpeg'
+    candidates = [variant for variant in variants_for(image_id) if variant.format == fmt]
+    for variant in candidates:
+        if variant.width >= width:
+            return variant
+    return candidates[-1] if candidates else None
+
+
+def forget_variants(image_id):
+    variant_infos.delete(image_id)
+
+
+@images_cli.command('backfill-variants')
+@click.option('--batch-size', default=100, show_default=True)
+def backfill_variants(batch_size):
+    """Построить недостающие варианты для уже загруженных изображений."""
+    if PILImage is None:
+        raise click.ClickException('Для построения вариантов нужен пакет Pillow')
+    expected = len(current_app.config['IMAGE_VARIANT_WIDTHS']) * len(current_app.config['IMAGE_VARIANT_FORMATS'])
+    complete = db.session.query(ImageVariant.image_id) \
+        .group_by(ImageVariant.image_id) \
+        .having(sa.func.count() >= expected)
+    done = failed = 0
+    last_id = ''
+    while True:
+        batch = Image.query \
+            .filter(Image.id > last_id, Image.id.notin_(complete)) \
+            .order_by(Image.id) \
+            .limit(batch_size) \
+            .all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        futures = {}
+        for img in batch:
+            if storage().exists(img.storage_key):
+                future, workdir = _submit(img)
+                futures[future] = (img, workdir)
+        for future in as_completed(futures):
+            img, workdir = futures[future]
+            try:
+                if future.exception() is not None:
+                    failed += 1
+                    click.echo(f'{img.id}: {future.exception()}', err=True)
+                    continue
+                _store(img.md5_hash, workdir, future.result())
+                done += 1
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        click.echo(f'Обработано изображений: {done}, ошибок: {failed}')
@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+from app import reference
+from app.models import db, Book, Review, book_genre
+from app.constants import RATING_WORDS
+
+CARD_COLUMNS = (
+    Book.id, Book.name, Book.author, Book.created_at, Book.version,
+    Book.approved_review_count, Book.rating_num, Book.rating_sum, Book.background_image_id,
+)
+REVIEW_COLUMNS = (Review.id, Review.rating, Review.text, Review.created_at, Review.status_id, Review.book_id)
+
+
+# Данные карточки каталога: только выводимые колонки и жанры из справочника, без описания книги
+class BookCardView(namedtuple('BookCardView', [column.key for column in CARD_COLUMNS] + ['genres'])):
+    __slots__ = ()
+
+    @property
+    def rating(self):
+        if self.rating_num > 0:
+            return self.rating_sum / self.rating_num
+        return 0
+
+
+# Рецензия в списке "Мои рецензии"
+class ReviewView(namedtuple('ReviewView', [column.key for column in REVIEW_COLUMNS])):
+    __slots__ = ()
+
+    @property
+    def rating_word(self):
+        return RATING_WORDS.get(self.rating)
+
+    @property
+    def current_status(self):
+        return reference.review_status(self.status_id)
+
+
+# Жанры книг одним запросом к book_genre; названия берутся из справочника в памяти
+def genre_map(book_ids):
+    genres = {book_id: [] for book_id in book_ids}
+    if book_ids:
+        rows = db.session.query(book_genre.c['book.id'], book_genre.c['genre.id']) \
+            .filter(book_genre.c['book.id'].in_(book_ids)) \
+            .order_by(book_genre.c['genre.id'])
+        for book_id, genre_id in rows:
+            genres[book_id].append(reference.genre(genre_id))
+    return {book_id: tuple(items) for book_id, items in genres.items()}
+
+
+# Карточки книг с данными id двумя запросами: колонки книг и их жанры
+def book_card_views(book_ids):
+    rows = db.session.query(*CARD_COLUMNS).filter(Book.id.in_(book_ids)).all() if book_ids else []
+    genres = genre_map([row.id for row in rows])
+    return [BookCardView(*row, genres[row.id]) for row in rows]
+
+
+def review_views(rows):
+    return [ReviewView(*row) for row in rows]
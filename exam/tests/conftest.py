@@ -0,0 +1,53 @@
+import pytest
+import sqlalchemy as sa
+
+from app.app import app as flask_app
+from app.models import db
+from app.seed import BENCH_USERS
+
+# Небольшая синтетическая база: на ней проверяются число запросов страниц и планы запросов
+SEED_ARGS = ['--books', '120', '--reviews', '1500', '--users', '30', '--collections', '20', '--password', 'bench']
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI='sqlite://',
+        SQLALCHEMY_BINDS={},
+        DB_REPLICA_BINDS=[],
+        SQLALCHEMY_ECHO=False,
+    )
+    with flask_app.app_context():
+        db.create_all()
+        result = flask_app.test_cli_runner().invoke(args=['seed'] + SEED_ARGS)
+        assert result.exit_code == 0, result.output
+        yield flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Вход от имени пользователя бенчмарка: 'admin', 'moder' или 'user'
+@pytest.fixture
+def login(client):
+    def login(role):
+        response = client.post('/auth/login', data={'login': BENCH_USERS[role][0], 'password': 'bench'})
+        assert response.status_code == 302
+        return client
+    return login
+
+
+# Тексты SQL-запросов, выполненных с момента очистки списка
+@pytest.fixture
+def queries(app):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    sa.event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    sa.event.remove(db.engine, 'before_cursor_execute', record)
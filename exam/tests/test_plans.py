@@ -0,0 +1,6 @@
+from app.plans import hot_queries, full_scans
+
+
+def test_hot_queries_use_indexes(app):
+    scans = {name: full_scans(query) for name, query in hot_queries()}
+    assert {name: tables for name, tables in scans.items() if tables} == {}
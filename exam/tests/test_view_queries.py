@@ -0,0 +1,35 @@
+import pytest
+
+from app.fragments import fragments
+from app.models import Collection, User
+from app.pagination import counts
+from app.seed import BENCH_USERS
+
+
+# Первый запрос прогревает справочники, пользователя и фасеты; замеряется второй,
+# с пустыми кэшами фрагментов и общего числа строк
+def page_queries(client, queries, url):
+    assert client.get(url).status_code == 200
+    fragments.local.clear()
+    counts.clear()
+    queries.clear()
+    assert client.get(url).status_code == 200
+    return len(queries)
+
+
+@pytest.fixture
+def collection_id(app):
+    user_id = User.query.filter_by(login=BENCH_USERS['user'][0]).one().id
+    return Collection.query.filter_by(user_id=user_id).order_by(Collection.id).first().id
+
+
+def test_catalogue_page(login, queries):
+    assert 4 <= page_queries(login('user'), queries, '/books/') <= 6
+
+
+def test_collection_page(login, queries, collection_id):
+    assert 4 <= page_queries(login('user'), queries, f'/collections/{collection_id}') <= 6
+
+
+def test_my_reviews_page(login, queries):
+    assert page_queries(login('user'), queries, '/books/my_reviews') == 2